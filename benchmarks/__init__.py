@@ -0,0 +1,9 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Benchmarks for oocd-tool and oocd-rpcd, run with: python -m benchmarks.run
+#
@@ -0,0 +1,95 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Scripted stand-in for openocd. Writes 'lines' lines of output to stderr over 'delay'
+# seconds and exits with 'exit_code'. With --tcl-port it serves the openocd TCL port
+# like a session (see OpenOcdSession), each command takes 'delay' seconds. --gdb-port
+# prints the line openocd prints when it accepts gdb connections after 'startup' seconds.
+#
+import sys
+import socket
+import argparse
+from time import sleep
+
+_TERMINATOR = b'\x1a'
+
+
+def _output(lines, line_size):
+    return ''.join('Info : fake openocd line {:06d} {}\n'.format(i, 'x' * max(line_size - 32, 0))
+                   for i in range(lines))
+
+
+def run_command(delay, lines, line_size, exit_code):
+    output = _output(lines, line_size)
+    if lines and delay:
+        step = delay / lines
+        for line in output.splitlines(keepends=True):
+            sys.stderr.write(line)
+            sys.stderr.flush()
+            sleep(step)
+    else:
+        sleep(delay)
+        sys.stderr.write(output)
+    return exit_code
+
+
+def _serve_connection(conn, delay, output, exit_code):
+    data = b''
+    while True:
+        chunk = conn.recv(4096)
+        if not chunk:
+            return
+        data += chunk
+        while _TERMINATOR in data:
+            cmd, _, data = data.partition(_TERMINATOR)
+            if cmd.startswith(b'catch '):
+                sleep(delay)
+                reply = b'0' if exit_code == 0 else b'1'
+            elif cmd.startswith(b'set _oocd_result'):
+                reply = output.encode()
+            else:
+                reply = b''
+            conn.sendall(reply + _TERMINATOR)
+
+
+def serve_tcl(port, delay, lines, line_size, exit_code):
+    output = _output(lines, line_size)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('localhost', port))
+    server.listen(1)
+    sys.stderr.write('Info : Listening on port {} for tcl connections\n'.format(port))
+    sys.stderr.flush()
+    while True:
+        conn, _ = server.accept()
+        with conn:
+            _serve_connection(conn, delay, output, exit_code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fake openocd')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds per command')
+    parser.add_argument('--lines', type=int, default=10, help='lines of output per command')
+    parser.add_argument('--line-size', type=int, default=80, help='bytes per output line')
+    parser.add_argument('--exit-code', type=int, default=0, help='exit code, non zero fails TCL commands')
+    parser.add_argument('--tcl-port', type=int, help='serve the TCL port instead of running once')
+    parser.add_argument('--gdb-port', type=int, help='report listening on this gdb port')
+    parser.add_argument('--startup', type=float, default=0.0, help='seconds before reporting the gdb port')
+    parser.add_argument('args', nargs='*', help='ignored, e.g. the image to program')
+    args = parser.parse_args()
+    if args.gdb_port:
+        sleep(args.startup)
+        sys.stderr.write('Info : Listening on port {} for gdb connections\n'.format(args.gdb_port))
+        sys.stderr.flush()
+    if args.tcl_port:
+        serve_tcl(args.tcl_port, args.delay, args.lines, args.line_size, args.exit_code)
+        return 0
+    return run_command(args.delay, args.lines, args.line_size, args.exit_code)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Synthetic log writer. Each line starts with its write time (time.time()) so readers
+# can measure the latency of a log stream.
+#
+import sys
+import time
+import argparse
+import threading
+
+
+def line(seq, size):
+    text = f'{time.time():.6f} {seq:08d} '
+    return text + 'x' * max(size - len(text) - 1, 0) + '\n'
+
+
+def line_time(data):
+    """Returns the write time of a line written by LogWriter."""
+    return float(data.split(b' ', 1)[0])
+
+
+class LogWriter:
+    """Appends 'count' lines of 'size' bytes to 'filename' at 'rate' lines per second,
+    as fast as possible if 'rate' is 0. Lines are flushed in bursts of 'burst' lines."""
+
+    def __init__(self, filename, count, size=80, rate=0, burst=1):
+        self.filename = filename
+        self.count = count
+        self.size = size
+        self.rate = rate
+        self.burst = burst
+        self._thread = None
+
+    def run(self):
+        start = time.monotonic()
+        with open(self.filename, 'a', buffering=1 << 16) as f:
+            for seq in range(0, self.count, self.burst):
+                n = min(self.burst, self.count - seq)
+                f.write(''.join(line(seq + i, self.size) for i in range(n)))
+                f.flush()
+                if self.rate:
+                    delay = start + (seq + n) / self.rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic log writer')
+    parser.add_argument('file', help='log file to append to')
+    parser.add_argument('--count', type=int, default=10000, help='number of lines')
+    parser.add_argument('--size', type=int, default=80, help='bytes per line')
+    parser.add_argument('--rate', type=float, default=0, help='lines per second, 0 for unlimited')
+    parser.add_argument('--burst', type=int, default=1, help='lines per write')
+    args = parser.parse_args()
+    LogWriter(args.file, args.count, args.size, args.rate, args.burst).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,248 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Starts a local oocd-rpcd against benchmarks.fake_openocd and measures program latency,
+# upload throughput vs chunk size, log stream latency and throughput, and TLS overhead.
+# Results are written as JSON.
+#
+#   python -m benchmarks.run [-o results.json] [--quick] [--only program,upload,log,tls]
+#
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+import grpc
+import oocd_tool.rpc_client as rpc_client
+from oocd_tool.compression import available_encodings
+from oocd_tool.process_registry import ProcessRegistry
+from benchmarks.log_writer import LogWriter, line_time
+
+_ROOT = Path(__file__).resolve().parent.parent
+_FAKE_OPENOCD = f'{sys.executable} -m benchmarks.fake_openocd'
+_AUTH_KEY = 'benchmark-key'
+_CHUNK_SIZES = (16384, 65536, 262144, 1048576)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def _summary(values):
+    """Returns count, mean, median, p95 and max of a list of seconds, in milliseconds."""
+    ordered = sorted(values)
+    return {'count': len(ordered),
+            'mean_ms': statistics.mean(ordered) * 1e3,
+            'p50_ms': ordered[len(ordered) // 2] * 1e3,
+            'p95_ms': ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1e3,
+            'max_ms': ordered[-1] * 1e3}
+
+
+def _write_image(path, size):
+    """Writes an incompressible image, different on every call."""
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return str(path)
+
+
+class Rpcd:
+    """oocd-rpcd in a subprocess with a generated configuration and fake openocd commands."""
+
+    def __init__(self, workdir, tls=False, session=False, delay=0.0, lines=10):
+        self.workdir = Path(workdir)
+        self.tls = tls
+        self.session = session
+        self.delay = delay
+        self.lines = lines
+        self.port = _free_port()
+        self._proc = None
+
+    @property
+    def address(self):
+        return f'localhost:{self.port}'
+
+    def client(self, chunk_max=rpc_client._CHUNK_MAX):
+        channel = rpc_client.secure_channel if self.tls else rpc_client.insecure_channel
+        return rpc_client.ClientChannel(self.address, channel, _AUTH_KEY if self.tls else '', chunk_max=chunk_max)
+
+    def _config(self):
+        fake = f'{_FAKE_OPENOCD} --delay {self.delay} --lines {self.lines}'
+        lines = ['[DEFAULT]',
+                 f'bindto: {self.address}',
+                 f'cmd_program: {fake} {{}}',
+                 f'cmd_reset: {fake}',
+                 f'cmd_debug: {_FAKE_OPENOCD} --gdb-port 3333 --delay 3600',
+                 f'image_cache: {self.workdir / "images"}',
+                 f'pid_dir: {self.workdir / f"run-{self.port}"}',
+                 'image_cache_size: 1024']
+        lines += [f'cert_auth_key: {_AUTH_KEY}'] if self.tls else ['tls_mode: disabled']
+        if self.session:
+            tcl_port = _free_port()
+            lines += ['session: enabled',
+                      f'tcl_port: {tcl_port}',
+                      f'cmd_session: {fake} --tcl-port {tcl_port}',
+                      'tcl_program: program {}',
+                      'tcl_reset: reset']
+        return '\n'.join(lines) + '\n'
+
+    def __enter__(self):
+        config = self.workdir / f'rpcd-{self.port}.cfg'
+        config.write_text(self._config())
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(_ROOT), os.environ.get('PYTHONPATH', '')]))
+        self._proc = subprocess.Popen([sys.executable, '-m', 'oocd_tool.rpc_server', str(config)],
+                                      cwd=self.workdir, env=env, start_new_session=True,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10.0
+        while True:
+            try:
+                socket.create_connection(('localhost', self.port), timeout=1.0).close()
+                return self
+            except OSError:
+                if self._proc.poll() is not None or time.monotonic() > deadline:
+                    self.__exit__()
+                    raise RuntimeError('oocd-rpcd did not start')
+                time.sleep(0.05)
+
+    def __exit__(self, *_exc):
+        if self._proc.poll() is None:
+            os.killpg(self._proc.pid, 15)
+            self._proc.wait()
+        # openocd sessions run in their own process group
+        ProcessRegistry(self.workdir / f'run-{self.port}').terminate_all('rpcd.')
+
+
+def bench_program(rpcd, runs, image_size):
+    """End-to-end latency of ProgramDevice, uploading a new image and with the image cached."""
+    rpc = rpcd.client()
+    upload = []
+    for i in range(runs):
+        image = _write_image(rpcd.workdir / f'upload-{i}.bin', image_size)
+        start = time.monotonic()
+        for _line in rpc.program_device(image):
+            pass
+        upload.append(time.monotonic() - start)
+    cached = []
+    for _i in range(runs):
+        start = time.monotonic()
+        for _line in rpc.program_device(image):
+            pass
+        cached.append(time.monotonic() - start)
+    return {'image_bytes': image_size, 'upload': _summary(upload), 'cached': _summary(cached)}
+
+
+def bench_upload(rpcd, image_size, runs):
+    """Upload throughput of an incompressible image per maximum chunk size. Only the upload is
+    timed, not the openocd run after it."""
+    results = []
+    for chunk_max in _CHUNK_SIZES:
+        rpc = rpcd.client(chunk_max)
+        rates = []
+        for i in range(runs):
+            image = _write_image(rpcd.workdir / f'chunk-{chunk_max}-{i}.bin', image_size)
+            for _line in rpc.program_device(image):
+                pass
+            stats = rpc.upload_stats
+            rates.append(stats.size / stats.elapsed)
+        results.append({'chunk_max': chunk_max, 'mb_per_s': statistics.median(rates) / 1e6})
+    return {'image_bytes': image_size, 'encoding': available_encodings()[0], 'chunks': results}
+
+
+def _stream_lines(rpcd, filename, count, writer_args, interval_ms):
+    """Streams 'filename' until 'count' lines written by a LogWriter are received.
+    Returns (latencies, elapsed)."""
+    with open(filename, 'w') as f:
+        f.write('0 start\n')
+    rpc = rpcd.client()
+    writer = None
+    latencies = []
+    start = None
+    try:
+        for block in rpc.log_stream_blocks(str(filename), interval_ms):
+            received = time.time()
+            for data in block.splitlines():
+                if data.startswith(b'---'):
+                    continue  # gap marker
+                if data.endswith(b'start'):
+                    # stream is running, start writing
+                    writer = LogWriter(filename, count, *writer_args)
+                    start = time.monotonic()
+                    writer.start()
+                    continue
+                latencies.append(received - line_time(data))
+            if len(latencies) >= count:
+                break
+    except grpc.RpcError as e:
+        raise RuntimeError(f'log stream failed: {e.code().name}')
+    elapsed = time.monotonic() - start
+    writer.join()
+    return latencies, elapsed
+
+
+def bench_log(rpcd, count, rate, interval_ms=5):
+    """Log line latency at 'rate' lines per second, and lines per second when flooding."""
+    latencies, _elapsed = _stream_lines(rpcd, rpcd.workdir / 'latency.log', count, (80, rate, 1), interval_ms)
+    flood = count * 20
+    _latencies, elapsed = _stream_lines(rpcd, rpcd.workdir / 'flood.log', flood, (80, 0, 100), interval_ms)
+    return {'latency': dict(_summary(latencies), rate=rate, batch_interval_ms=interval_ms),
+            'throughput': {'lines': flood, 'lines_per_s': flood / elapsed}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='oocd-tool benchmarks')
+    parser.add_argument('-o', dest='output', metavar='FILE', help='write results to FILE instead of stdout')
+    parser.add_argument('--quick', action='store_true', help='fewer runs and smaller images')
+    parser.add_argument('--only', metavar='LIST', default='program,upload,log,tls',
+                        help='comma separated: program,upload,log,tls')
+    parser.add_argument('--delay', type=float, default=0.05, help='fake openocd delay per command')
+    args = parser.parse_args()
+    only = set(args.only.split(','))
+    runs = 3 if args.quick else 10
+    image_size = (256 if args.quick else 1024) * 1024
+    log_lines = 500 if args.quick else 5000
+
+    results = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'python': platform.python_version(),
+                        'grpc': grpc.__version__, 'platform': platform.platform(), 'quick': args.quick,
+                        'fake_openocd_delay': args.delay}}
+    with tempfile.TemporaryDirectory(prefix='oocd-bench-') as workdir:
+        if 'program' in only:
+            for session in (False, True):
+                with Rpcd(workdir, session=session, delay=args.delay) as rpcd:
+                    results[f'program_{"session" if session else "spawn"}'] = bench_program(rpcd, runs, image_size)
+        if 'upload' in only:
+            with Rpcd(workdir, delay=0.0, lines=1) as rpcd:
+                results['upload'] = bench_upload(rpcd, image_size * 4, max(runs // 3, 1))
+        if 'log' in only:
+            with Rpcd(workdir) as rpcd:
+                results['log'] = bench_log(rpcd, log_lines, 1000)
+        if 'tls' in only:
+            tls = {}
+            for secure in (False, True):
+                with Rpcd(workdir, tls=secure, delay=0.0, lines=1) as rpcd:
+                    tls['tls' if secure else 'insecure'] = {
+                        'program_cached': bench_program(rpcd, runs, image_size)['cached'],
+                        'log': bench_log(rpcd, log_lines, 1000)}
+            results['tls'] = tls
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Startup budget of oocd-tool in local mode. Fails (exit code 1) if a local dry run takes more
+# than --budget milliseconds over a bare interpreter start, or if it loads modules only needed
+# for remote mode.
+#
+#   python -m benchmarks.startup [--budget 100] [--runs 20]
+#
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+_ROOT = Path(__file__).resolve().parent.parent
+# must not be imported by local modes and dry runs
+_REMOTE_ONLY = ('grpc', 'google.protobuf', 'psutil', 'oocd_tool._credentials', 'oocd_tool.rpc_client')
+
+_CONFIG = """[DEFAULT]
+config_path: @CONFIG@
+gdb_executable: gdb
+gdb_args: -ex "target extended-remote localhost:3333" @ELFFILE@
+openocd_executable: openocd
+[program]
+openocd_args: -f board.cfg -c "program @ELFFILE@ verify reset exit"
+mode: openocd
+"""
+
+_PROBE = """import sys, json, runpy
+sys.argv = ['oocd-tool'] + sys.argv[1:]
+try:
+    runpy.run_module('oocd_tool.main', run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps(sorted(sys.modules)))
+"""
+
+
+def _run(args, env):
+    start = time.monotonic()
+    proc = subprocess.run(args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    return time.monotonic() - start, proc.stderr.decode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='oocd-tool startup budget')
+    parser.add_argument('--budget', type=float, default=100.0, help='milliseconds over a bare interpreter start')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='oocd-startup-') as home:
+        config = Path(home, 'oocd-tool.cfg')
+        config.write_text(_CONFIG)
+        # HOME keeps the default configuration created at first run out of the user's home
+        env = dict(os.environ, HOME=home, PYTHONPATH=os.pathsep.join([str(_ROOT), os.environ.get('PYTHONPATH', '')]))
+        dry_run = [sys.executable, '-m', 'oocd_tool.main', '-c', str(config), '-d', 'program']
+
+        _elapsed, modules = _run([sys.executable, '-c', _PROBE, '-c', str(config), '-d', 'program'], env)
+        loaded = sorted({module for name in json.loads(modules) for module in _REMOTE_ONLY
+                         if name == module or name.startswith(module + '.')})
+        _run(dry_run, env)  # first run creates ~/.oocd-tool and byte code
+        bare = statistics.median(_run([sys.executable, '-c', 'pass'], env)[0] for _i in range(args.runs))
+        cli = statistics.median(_run(dry_run, env)[0] for _i in range(args.runs))
+
+    overhead = (cli - bare) * 1e3
+    result = {'interpreter_ms': bare * 1e3, 'dry_run_ms': cli * 1e3, 'overhead_ms': overhead,
+              'budget_ms': args.budget, 'remote_only_modules_loaded': loaded}
+    print(json.dumps(result, indent=2))
+    if loaded:
+        sys.stderr.write(f'FAIL: local mode loaded {", ".join(loaded)}\n')
+        return 1
+    if overhead > args.budget:
+        sys.stderr.write(f'FAIL: startup overhead {overhead:.1f} ms exceeds budget of {args.budget:.1f} ms\n')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -21,20 +21,30 @@ def _load_credential_from_file(filepath):
         return f.read()
 
 
-SERVER_CERTIFICATE = _load_credential_from_file('credentials/localhost.crt')
-SERVER_CERTIFICATE_KEY = _load_credential_from_file('credentials/localhost.key')
-ROOT_CERTIFICATE = _load_credential_from_file('credentials/root.crt')
+# files of SERVER_CERTIFICATE, SERVER_CERTIFICATE_KEY and ROOT_CERTIFICATE, read on first access
+_FILES = {'SERVER_CERTIFICATE': 'credentials/localhost.crt',
+          'SERVER_CERTIFICATE_KEY': 'credentials/localhost.key',
+          'ROOT_CERTIFICATE': 'credentials/root.crt'}
+
+
+def __getattr__(name):
+    if name not in _FILES:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    value = globals()[name] = _load_credential_from_file(_FILES[name])
+    return value
+
+
+def _set_file(name, filepath):
+    _FILES[name] = filepath
+    globals().pop(name, None)
 
 
 def load_certificates(config):
     if 'root_ca' in config:
-        global ROOT_CERTIFICATE
-        ROOT_CERTIFICATE = _load_credential_from_file(config.root_ca)
+        _set_file('ROOT_CERTIFICATE', config.root_ca)
     if 'server_cert' in config:
-        global SERVER_CERTIFICATE
-        SERVER_CERTIFICATE = _load_credential_from_file(config.server_cert)
+        _set_file('SERVER_CERTIFICATE', config.server_cert)
     if 'server_key' in config:
-        global SERVER_CERTIFICATE_KEY
-        SERVER_CERTIFICATE_KEY = _load_credential_from_file(config.server_key)
+        _set_file('SERVER_CERTIFICATE_KEY', config.server_key)
 
 
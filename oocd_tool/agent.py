@@ -0,0 +1,328 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# oocd-agent keeps channels to oocd-rpcd hosts open between oocd-tool runs. oocd-tool sends
+# its request over a Unix domain socket and gets the output back, it does not load grpc and
+# does no TLS handshake itself.
+#
+# Protocol: the client sends one JSON object terminated by a newline, the agent replies with
+# frames of a type byte, a 4 byte length (big endian) and the payload, the last one is
+# _DONE or _ERROR. The client closes the connection to cancel the request.
+#
+import os
+import sys
+import json
+import socket
+import struct
+import signal
+import logging
+import argparse
+import threading
+import contextlib
+import socketserver
+from pathlib import Path
+
+_LOGGER = logging.getLogger(__name__)
+
+_SOCKET = Path(Path.home(), '.oocd-tool', 'agent.sock')
+_HEADER = struct.Struct('>cI')
+_ITM_HEADER = struct.Struct('>Id')
+
+# frame types
+_LINE = b'L'
+_BLOCK = b'B'
+_ITM = b'I'
+_STDERR = b'S'
+_ERROR = b'E'
+_DONE = b'D'
+
+
+class AgentException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def _connect(path):
+    """Returns a socket connected to the agent, None if it is not running."""
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+        return sock
+    except OSError:
+        sock.close()
+        return None
+
+
+def is_running(path=_SOCKET):
+    sock = _connect(path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+class AgentClient:
+    """Counterpart of rpc_client.ClientChannel executing the calls through oocd-agent."""
+
+    def __init__(self, path, host, tls, auth, root_ca='', device='', chunk_max=0, verbose=False,
+                 priority='interactive', deadline=None):
+        self._path = path
+        self._verbose = verbose
+        self._target = {'host': host, 'tls': tls, 'auth': auth, 'root_ca': root_ca, 'device': device,
+                        'chunk_max': chunk_max, 'priority': priority, 'deadline': deadline}
+
+    def _call(self, cmd, **args):
+        """Yields the (type, payload) frames of a request."""
+        sock = _connect(self._path)
+        if sock is None:
+            raise AgentException(f"Error: oocd-agent is not running on '{self._path}'.")
+        with sock, sock.makefile('rb') as f:
+            sock.sendall(json.dumps(dict(self._target, cmd=cmd, **args)).encode() + b'\n')
+            while True:
+                try:
+                    header = f.read(_HEADER.size)
+                    if len(header) < _HEADER.size:
+                        raise AgentException('Error: oocd-agent closed the connection.')
+                    kind, size = _HEADER.unpack(header)
+                    payload = f.read(size)
+                except KeyboardInterrupt:
+                    # closing the connection cancels the request
+                    sys.exit(0)
+                if kind == _DONE:
+                    return
+                if kind == _ERROR:
+                    raise AgentException(payload.decode())
+                if kind == _STDERR:
+                    sys.stderr.write(payload.decode())
+                    continue
+                yield kind, payload
+
+    def program_device(self, file):
+        for _kind, line in self._call('program', file=os.path.abspath(file), verbose=self._verbose):
+            yield line.decode()
+
+    def reset_device(self):
+        for _kind, line in self._call('reset'):
+            yield line.decode()
+
+    def log_stream_blocks(self, file, interval_ms, batch_size=65536, **filters):
+        for _kind, block in self._call('logstream', file=file, interval_ms=interval_ms, batch_size=batch_size,
+                                       filters=filters):
+            yield block
+
+    def log_stream_itm(self, file, ports, ts_freq, interval_ms, **filters):
+        for _kind, payload in self._call('itmstream', file=file, ports=list(ports), ts_freq=ts_freq,
+                                         interval_ms=interval_ms, filters=filters):
+            port, timestamp = _ITM_HEADER.unpack_from(payload)
+            yield port, timestamp, payload[_ITM_HEADER.size:]
+
+    def start_debug(self):
+        # agents without leases send nothing
+        lease = '', 0
+        for _kind, payload in self._call('start_debug'):
+            lease = json.loads(payload)
+        return tuple(lease)
+
+    def renew_debug(self, lease_id):
+        try:
+            for _kind, payload in self._call('renew_debug', lease_id=lease_id):
+                return json.loads(payload)
+        except (AgentException, OSError):
+            return None
+
+    def stop_debug(self, lease_id=''):
+        for _frame in self._call('stop_debug', lease_id=lease_id):
+            pass
+
+    def debug_device(self):
+        from oocd_tool.lease import debug_session
+        return debug_session(self)
+
+
+class ChannelPool:
+    """One channel per host, credentials and root certificate, kept open with keepalive pings."""
+
+    def __init__(self):
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, tls, auth, root_ca):
+        import grpc
+        import oocd_tool.rpc_client as rpc_client
+        import oocd_tool._credentials as _credentials
+        key = (host, tls, auth, root_ca)
+        with self._lock:
+            channel = self._channels.get(key)
+            if channel is None:
+                # idle channels are kept connected and checked, not only while a call is running
+                options = rpc_client._CHANNEL_OPTIONS + [('grpc.keepalive_permit_without_calls', 1),
+                                                         ('grpc.client_idle_timeout_ms', 0x7fffffff)]
+                if tls:
+                    root_certificate = _credentials._load_credential_from_file(root_ca) if root_ca else None
+                    channel = rpc_client.create_secure_channel(host, auth, root_certificate, options)
+                else:
+                    channel = grpc.insecure_channel(host, options=options)
+                self._channels[key] = channel
+                _LOGGER.info(f"New channel to '{host}' (tls: {tls}).")
+            return channel
+
+    def channel_type(self, tls, root_ca):
+        """Returns a channel function for rpc_client.ClientChannel using the pool."""
+        @contextlib.contextmanager
+        def channel(addr, auth):
+            yield self.get(addr, tls, auth, root_ca)
+        return channel
+
+    def close(self):
+        with self._lock:
+            for channel in self._channels.values():
+                channel.close()
+            self._channels.clear()
+
+
+def _execute(pool, request, on_call, status):
+    """Yields the (type, payload) frames of a request. 'status' sends the queue position while waiting."""
+    import oocd_tool.rpc_client as rpc_client
+    # clients older than the agent send no priority
+    rpc = rpc_client.ClientChannel(request['host'], pool.channel_type(request['tls'], request['root_ca']),
+                                   request['auth'], request['device'], request['chunk_max'] or rpc_client._CHUNK_MAX,
+                                   False, on_call, request.get('priority', 'interactive'), request.get('deadline'),
+                                   status)
+    cmd = request['cmd']
+    if cmd == 'program':
+        for line in rpc.program_device(request['file']):
+            yield _LINE, line.encode()
+        if request['verbose'] and rpc.upload_stats is not None:
+            yield _STDERR, f'{rpc.upload_stats}\n'.encode()
+    elif cmd == 'reset':
+        for line in rpc.reset_device():
+            yield _LINE, line.encode()
+    elif cmd == 'logstream':
+        for block in rpc.log_stream_blocks(request['file'], request['interval_ms'], request['batch_size'],
+                                           **request['filters']):
+            yield _BLOCK, block
+    elif cmd == 'itmstream':
+        for port, timestamp, block in rpc.log_stream_itm(request['file'], request['ports'], request['ts_freq'],
+                                                         request['interval_ms'], **request['filters']):
+            yield _ITM, _ITM_HEADER.pack(port, timestamp) + block
+    elif cmd == 'start_debug':
+        yield _LINE, json.dumps(rpc.start_debug()).encode()
+    elif cmd == 'renew_debug':
+        yield _LINE, json.dumps(rpc.renew_debug(request['lease_id'])).encode()
+    elif cmd == 'stop_debug':
+        rpc.stop_debug(request.get('lease_id', ''))
+    else:
+        raise AgentException(f"Error: invalid agent command: '{cmd}'")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        import grpc
+        line = self.rfile.readline()
+        if not line:
+            return  # is_running() probe
+        calls = []
+        # the client closes the connection to cancel, also while nothing is sent to it
+        threading.Thread(target=self._watch, args=(calls,), daemon=True).start()
+        frames = None
+        try:
+            request = json.loads(line)
+            _LOGGER.debug(f"{request['cmd']} on '{request['host']}'")
+            frames = _execute(self.server.pool, request, calls.append,
+                              lambda text: self._send(_STDERR, text.encode()))
+            for kind, payload in frames:
+                self._send(kind, payload)
+            self._send(_DONE)
+        except ConnectionError:
+            _LOGGER.debug('Client disconnected.')
+        except grpc.RpcError as e:
+            self._send_error(f'Error: {e.code().name}: {e.details()}')
+        except AgentException as e:
+            self._send_error(e.message)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self._send_error(f'Error: {e}')
+        finally:
+            for call in calls:
+                call.cancel()
+            if frames is not None:
+                frames.close()
+
+    def _watch(self, calls):
+        with contextlib.suppress(OSError, ValueError):
+            while self.rfile.read(1):
+                pass
+        for call in list(calls):
+            call.cancel()
+
+    def _send(self, kind, payload=b''):
+        self.wfile.write(_HEADER.pack(kind, len(payload)) + payload)
+        self.wfile.flush()
+
+    def _send_error(self, message):
+        with contextlib.suppress(ConnectionError):
+            self._send(_ERROR, message.encode())
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.pool = ChannelPool()
+        # the socket is only accessible by the user
+        umask = os.umask(0o077)
+        try:
+            super().__init__(str(path), _Handler)
+        finally:
+            os.umask(umask)
+
+
+def serve(path=_SOCKET):
+    path = Path(path)
+    if is_running(path):
+        raise AgentException(f"Error: oocd-agent is already running on '{path}'.")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with contextlib.suppress(FileNotFoundError):
+        path.unlink()  # left behind by an agent that was killed
+    server = _Server(path)
+
+    def shutdown(_signum, _frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    _LOGGER.info(f"Listening on '{path}'.")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.pool.close()
+        with contextlib.suppress(FileNotFoundError):
+            path.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='oocd-agent, keeps connections to oocd-rpcd hosts for oocd-tool')
+    parser.add_argument('-s', dest='socket', default=str(_SOCKET), metavar='SOCKET',
+                        help=f'socket path (default: {_SOCKET})')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log requests and new channels')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    if not hasattr(socket, 'AF_UNIX'):
+        sys.stderr.write('Error: Unix domain sockets are not supported on this platform.\n')
+        return 1
+    try:
+        serve(args.socket)
+    except AgentException as e:
+        sys.stderr.write(e.message + '\n')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
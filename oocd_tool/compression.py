@@ -0,0 +1,74 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+import zlib
+
+# in order of preference
+_ENCODINGS = ['zstd', 'gzip']
+
+
+class CompressionException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def _has_zstd():
+    try:
+        import zstandard
+        return True
+    except ImportError:
+        return False
+
+
+def available_encodings():
+    return [e for e in _ENCODINGS if e != 'zstd' or _has_zstd()]
+
+
+def choose_encoding(remote_encodings):
+    """Returns the preferred encoding supported on both sides, '' for none."""
+    for encoding in available_encodings():
+        if encoding in remote_encodings:
+            return encoding
+    return ''
+
+
+def compressor(encoding):
+    """Returns an object with compress() and flush(), None for no compression."""
+    if encoding == '':
+        return None
+    if encoding == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if encoding == 'zstd' and _has_zstd():
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    raise CompressionException(f"Error: unsupported encoding: '{encoding}'")
+
+
+async def decompress_stream(chunks, encoding):
+    """Decompresses an async iterator of chunks."""
+    if encoding == '':
+        async for chunk in chunks:
+            yield chunk
+        return
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(31)
+        error = zlib.error
+    elif encoding == 'zstd' and _has_zstd():
+        import zstandard
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        error = zstandard.ZstdError
+    else:
+        raise CompressionException(f"Error: unsupported encoding: '{encoding}'")
+    try:
+        async for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+    except error as e:
+        raise CompressionException(f"Error: invalid {encoding} stream: {e}")
+    if encoding == 'gzip' and not decompressor.eof:
+        raise CompressionException("Error: truncated gzip stream.")
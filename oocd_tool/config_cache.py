@@ -0,0 +1,87 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+import os
+import json
+import hashlib
+import contextlib
+from pathlib import Path
+
+# bumped when the format of compiled sections changes
+_VERSION = 1
+
+
+def _digest(file):
+    return hashlib.sha256(file.read_bytes()).hexdigest()
+
+
+class ConfigCache:
+    """Compiled sections of one config file and the executables found for it, stored as JSON in
+    'directory'. The cache is invalidated when the file changes: a changed mtime or size makes
+    it compare the SHA-256 of the file, a changed content drops all sections."""
+
+    def __init__(self, directory, file, config_path):
+        self.file = Path(file).resolve()
+        self.config_path = config_path
+        name = hashlib.sha256(str(self.file).encode()).hexdigest()[:16]
+        self._path = Path(directory, f'config-{name}.json')
+        self._dirty = False
+        self._entry = self._load()
+
+    def _load(self):
+        stat = self.file.stat()
+        try:
+            entry = json.loads(self._path.read_text())
+        except (OSError, ValueError):
+            entry = None
+        self._dirty = True
+        if entry is None or entry.get('version') != _VERSION or entry.get('config_path') != self.config_path:
+            return self._new(stat, _digest(self.file))
+        if entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            self._dirty = False
+            return entry
+        digest = _digest(self.file)
+        if entry['sha256'] != digest:
+            return self._new(stat, digest)
+        # touched but not changed
+        entry['mtime_ns'] = stat.st_mtime_ns
+        return entry
+
+    def _new(self, stat, digest):
+        return {'version': _VERSION, 'config_path': self.config_path, 'mtime_ns': stat.st_mtime_ns,
+                'size': stat.st_size, 'sha256': digest, 'sections': {}, 'executables': {}}
+
+    def section(self, name, compile):
+        """Returns the compiled section 'name', calls compile() if it is not cached."""
+        compiled = self._entry['sections'].get(name)
+        if compiled is None:
+            compiled = self._entry['sections'][name] = compile()
+            self._dirty = True
+        return compiled
+
+    def which(self, executable):
+        """shutil.which() for the executables of the config, remembered as long as they exist."""
+        path = self._entry['executables'].get(executable)
+        if path is not None and os.access(path, os.X_OK):
+            return path
+        import shutil
+        path = shutil.which(executable)
+        if path is not None:
+            self._entry['executables'][executable] = path
+            self._dirty = True
+        return path
+
+    def save(self):
+        if not self._dirty:
+            return
+        # the cache is only an optimization, a read-only home is fine
+        with contextlib.suppress(OSError):
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self._path.with_name(f'{self._path.name}.{os.getpid()}')
+            tmp.write_text(json.dumps(self._entry))
+            os.replace(tmp, self._path)
+            self._dirty = False
@@ -54,6 +54,16 @@ proc reset_device { } {
 	shutdown
 }
 
+# used by oocd-rpcd in session mode, openocd keeps running
+proc program_target { SOURCE } {
+	program $SOURCE verify
+	reset run
+}
+
+proc reset_target { } {
+	reset run
+}
+
 init
 """
 
@@ -65,7 +75,23 @@ config.2: openocd_gdbinit
 gdb_executable: arm-none-eabi-gdb-py
 gdb_args: -ex "target extended-remote localhost:3333" -x @config.1@ -x @config.2@ @ELFFILE@
 openocd_remote: localhost:50051
+# device on the rpc host, when oocd-rpcd serves more than one probe
+#device: board1
+# maximum upload chunk size in KB, chunks grow towards it on fast links
+#upload_chunk_max: 256
+# queueing on a busy device: 'batch' requests (CI) wait for 'interactive' ones, 'deadline' in
+# seconds for the whole program/reset, rejected at once if it cannot be met
+#priority: batch
+#deadline: 120
+# ELF files are stripped to their loadable segments before upload
+#strip_elf: disabled
 #tls_mode: disabled
+# requests go through oocd-agent if it is running, see README.md
+#agent: disabled
+#agent_socket: ~/.oocd-tool/agent.sock
+# gdb connects to this local port and is tunneled through the connection to oocd-rpcd, the gdb
+# port of the rpc host needs not be reachable. gdb_args must target localhost:<port>.
+#gdb_tunnel_port: 3333
 
 # TLS uses buildin demo certificate if none specified.
 # use 'examples/gen_certificates.sh -cn <hostname>' to generate new certificates. See README.md
@@ -81,8 +107,30 @@ mode: openocd
 openocd_args: reset
 mode: openocd
 
+# Programs all targets concurrently, syntax: host:port[/device]
+[program-all]
+openocd_remotes: pi1:50051 pi2:50051/board1 pi2:50051/board2
+openocd_args: program @ELFFILE@
+mode: openocd
+
 [log]
 openocd_args: logstream /tmp/test.log
+# log lines are coalesced by the server for up to 5 ms
+#log_batch_interval: 5
+# filtered on the server: regular expressions, lines of context around matches, lines per second
+#log_include: ERROR|ASSERT
+#log_exclude: DEBUG
+#log_context: 2
+#log_rate_limit: 1000
+mode: openocd
+
+# Decodes a raw ITM trace file on the server (see itm_log in openocd.cfg)
+[itm]
+openocd_args: itmstream /tmp/itm.bin
+# stimulus ports to show, all if not set
+#itm_ports: 0 1
+# timestamp clock, converts ITM local timestamps to host time
+#itm_ts_freq: @FCPU@
 mode: openocd
 
 [gdb]
@@ -99,6 +147,66 @@ bindto: 0.0.0.0:50051
 cmd_program: openocd -f /home/ocd/.oocd-tool/openocd.cfg -c "program_device {}"
 cmd_reset: openocd -f /home/ocd/.oocd-tool/openocd.cfg -c "reset_device"
 cmd_debug: /usr/bin/openocd -f /home/ocd/.oocd-tool/openocd.cfg
+# StartDebug returns when openocd is ready: a line on its stderr matches ready_pattern (empty to
+# not watch stderr) or all ready_ports accept connections, at most ready_timeout seconds.
+#ready_pattern: Listening on port \\d+ for gdb connections
+#ready_ports: {tcl_port}
+#ready_timeout: 10
+# debug sessions of oocd-tool are stopped if not renewed within this many seconds, e.g.
+# when the client is suspended or loses its connection
+#debug_lease_ttl: 30
+#
+# Session mode keeps one openocd running and sends commands through its TCL port.
+# Saves adapter initialization and target probing on every request.
+#session: enabled
+cmd_session: openocd -f /home/ocd/.oocd-tool/openocd.cfg
+tcl_program: program_target {}
+tcl_reset: reset_target
+tcl_port: 6666
+# gdb port of openocd, the target of the GdbTunnel of oocd-tool (gdb_tunnel_port)
+#gdb_port: 3333
+#session_timeout: 10
+#
+# Firmware images are kept by SHA-256, unchanged images are not uploaded again.
+#image_cache: /home/ocd/.oocd-tool/images
+#image_cache_size: 64
+#
+# Delta flashing writes only the flash sectors changed since the last programmed image.
+# Requires session mode and image_cache. Sector layout: <base> <count>x<size> ...
+#delta_flash: enabled
+flash_sectors: 0x08000000 4x16K 1x64K 7x128K
+#
+# Recent log lines are buffered per file (KB), clients resume from the buffer after a reconnect.
+# A file is followed for log_retention seconds after its last stream ended.
+#log_buffer_size: 1024
+#log_retention: 60
+# All streams of a file share one reader. Each stream has a queue (KB), a stream falling further
+# behind loses the oldest lines (log_lag_policy: drop) or is disconnected and resumes (disconnect).
+#log_queue_size: 1024
+#log_lag_policy: drop
+# Idle streams only cost a queue, they hold no thread.
+#max_log_streams: 256
+#
+# Metrics in the Prometheus text format on http://<metrics_bindto>/metrics
+#metrics_bindto: 0.0.0.0:9150
+
+# PID files of the openocd processes started by the daemon, they are terminated on the next start
+#pid_dir: /home/ocd/.oocd-tool/run
+#
+# Multiple probes: one [device.<name>] section per probe, keys not given are taken from [DEFAULT].
+# Commands may refer to keys of the device section, e.g. {tcl_port}. Each device needs its own ports.
+# Operations on different devices run in parallel. Clients select a device with the 'device' key.
+#default_device: board1
+#
+#[device.board1]
+#tcl_port: 6666
+#gdb_port: 3333
+#cmd_session: openocd -c "gdb_port {gdb_port}; tcl_port {tcl_port}; telnet_port disabled" -f /home/ocd/.oocd-tool/board1.cfg
+#
+#[device.board2]
+#tcl_port: 6667
+#gdb_port: 3334
+#cmd_session: openocd -c "gdb_port {gdb_port}; tcl_port {tcl_port}; telnet_port disabled" -f /home/ocd/.oocd-tool/board2.cfg
 #
 # TLS uses buildin demo certificate if none specified
 # use 'examples/gen_certificates.sh -cn <hostname>' to generate new certificates. See README.md
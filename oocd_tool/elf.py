@@ -0,0 +1,116 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+import os
+import struct
+import hashlib
+import tempfile
+from pathlib import Path
+from collections import namedtuple
+
+PT_LOAD = 1
+
+Segment = namedtuple('Segment', ['paddr', 'data'])
+
+
+class ElfException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def _header(data):
+    if len(data) < 52 or data[:4] != b'\x7fELF':
+        raise ElfException('Error: not an ELF file.')
+    ei_class, ei_data = data[4], data[5]
+    if ei_class not in (1, 2) or ei_data not in (1, 2):
+        raise ElfException('Error: unsupported ELF class or encoding.')
+    endian = '<' if ei_data == 1 else '>'
+    if ei_class == 1:
+        phoff, = struct.unpack_from(endian + 'I', data, 28)
+        phentsize, phnum = struct.unpack_from(endian + 'HH', data, 42)
+        phdr = endian + 'IIIIIIII'
+    else:
+        phoff, = struct.unpack_from(endian + 'Q', data, 32)
+        phentsize, phnum = struct.unpack_from(endian + 'HH', data, 54)
+        phdr = endian + 'IIQQQQQQ'
+    return ei_class, phoff, phentsize, phnum, phdr
+
+
+def _program_headers(data):
+    ei_class, phoff, phentsize, phnum, phdr = _header(data)
+    for i in range(phnum):
+        fields = struct.unpack_from(phdr, data, phoff + i * phentsize)
+        if ei_class == 1:
+            p_type, p_offset, _vaddr, p_paddr, p_filesz = fields[:5]
+        else:
+            p_type, _flags, p_offset, _vaddr, p_paddr, p_filesz = fields[:6]
+        yield i, p_type, p_offset, p_paddr, p_filesz
+
+
+def load_segments(data):
+    """Returns the PT_LOAD segments with file data of an ELF image, as (physical address, data)."""
+    segments = []
+    for _i, p_type, p_offset, p_paddr, p_filesz in _program_headers(data):
+        if p_type != PT_LOAD or p_filesz == 0:
+            continue
+        if p_offset + p_filesz > len(data):
+            raise ElfException('Error: truncated ELF segment.')
+        segments.append(Segment(p_paddr, data[p_offset:p_offset + p_filesz]))
+    return segments
+
+
+def load_segments_from_file(filename):
+    with open(filename, 'rb') as f:
+        return load_segments(f.read())
+
+
+def strip_to_loadable(data):
+    """Returns an ELF image with only the ELF header, PT_LOAD program headers and segment data.
+    Section headers and non-loadable data (e.g. DWARF) are dropped."""
+    ei_class, phoff, phentsize, _phnum, phdr = _header(data)
+    endian = phdr[0]
+    loadable = [h for h in _program_headers(data) if h[1] == PT_LOAD and h[4] != 0]
+    if not loadable:
+        raise ElfException('Error: ELF file has no loadable segments.')
+    ehsize = 52 if ei_class == 1 else 64
+    header = bytearray(data[:ehsize])
+    # e_phoff, e_shoff, e_phnum, e_shentsize, e_shnum, e_shstrndx
+    if ei_class == 1:
+        struct.pack_into(endian + 'II', header, 28, ehsize, 0)
+    else:
+        struct.pack_into(endian + 'QQ', header, 32, ehsize, 0)
+    struct.pack_into(endian + 'HHHH', header, ehsize - 8, len(loadable), 0, 0, 0)
+    offset = ehsize + len(loadable) * phentsize
+    headers = bytearray()
+    body = bytearray()
+    for i, _type, p_offset, _paddr, p_filesz in loadable:
+        entry = bytearray(data[phoff + i * phentsize:phoff + (i + 1) * phentsize])
+        struct.pack_into(endian + ('I' if ei_class == 1 else 'Q'), entry, 4 if ei_class == 1 else 8,
+                         offset + len(body))
+        headers += entry
+        body += data[p_offset:p_offset + p_filesz]
+    return bytes(header + headers + body)
+
+
+def stripped_image(filename, cache_dir, max_files=32):
+    """Returns a stripped copy of an ELF file, cached in 'cache_dir' by hash of the input."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    cache = Path(cache_dir)
+    file = cache / f'{hashlib.sha256(data).hexdigest()}.elf'
+    if file.exists():
+        os.utime(file)
+        return str(file)
+    stripped = strip_to_loadable(data)
+    cache.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(stripped)
+    os.replace(tmp, file)
+    for old in sorted(cache.glob('*.elf'), key=lambda f: f.stat().st_mtime)[:-max_files]:
+        old.unlink()
+    return str(file)
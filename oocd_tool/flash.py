@@ -0,0 +1,71 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+import re
+from collections import namedtuple
+
+Sector = namedtuple('Sector', ['addr', 'size'])
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 * 1024}
+
+
+class FlashLayoutException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def parse_sector_layout(text):
+    """Parses a layout like '0x08000000 4x16K 1x64K 7x128K' into a list of sectors."""
+    tokens = text.split()
+    if len(tokens) < 2:
+        raise FlashLayoutException(f"Error: invalid flash_sectors: '{text}'")
+    try:
+        addr = int(tokens[0], 0)
+    except ValueError:
+        raise FlashLayoutException(f"Error: invalid flash_sectors base address: '{tokens[0]}'")
+    sectors = []
+    for token in tokens[1:]:
+        m = re.fullmatch(r'(\d+)x(\d+)([KM]?)', token, re.IGNORECASE)
+        if m is None:
+            raise FlashLayoutException(f"Error: invalid flash_sectors entry: '{token}'")
+        size = int(m.group(2)) * _UNITS[m.group(3).upper()]
+        for _ in range(int(m.group(1))):
+            sectors.append(Sector(addr, size))
+            addr += size
+    return sectors
+
+
+def sector_contents(segments, layout):
+    """Maps the segments onto the flash sectors, unprogrammed bytes are 0xff.
+    Returns None if a segment is not fully contained in the flash layout."""
+    contents = {}
+    for paddr, data in segments:
+        end = paddr + len(data)
+        if not layout or paddr < layout[0].addr or end > layout[-1].addr + layout[-1].size:
+            return None
+        for index, sector in enumerate(layout):
+            lo, hi = max(paddr, sector.addr), min(end, sector.addr + sector.size)
+            if lo >= hi:
+                continue
+            buf = contents.setdefault(index, bytearray(b'\xff' * sector.size))
+            buf[lo - sector.addr:hi - sector.addr] = data[lo - paddr:hi - paddr]
+    return contents
+
+
+def changed_ranges(old, new, layout):
+    """Returns (address, data) of the sectors differing between two images, adjacent sectors merged."""
+    ranges = []
+    for index, sector in enumerate(layout):
+        # sectors not covered by the new image are left untouched, like a full program does
+        data = new.get(index)
+        if data is None or data == old.get(index, b'\xff' * sector.size):
+            continue
+        if ranges and ranges[-1][0] + len(ranges[-1][1]) == sector.addr:
+            ranges[-1][1].extend(data)
+        else:
+            ranges.append((sector.addr, bytearray(data)))
+    return ranges
@@ -0,0 +1,66 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Local end of the GdbTunnel RPC: gdb connects to localhost instead of the gdb port on the rpc
+# host, which then needs no port open besides the one of oocd-rpcd.
+#
+import socket
+import threading
+import contextlib
+from oocd_tool.process import ProcessException
+
+
+class GdbTunnel:
+    """Listens on localhost:'port' while used as context manager, each gdb connection is passed
+    to forward(sock) in a thread, e.g. rpc_client.ClientChannel.gdb_tunnel."""
+
+    def __init__(self, forward, port):
+        self._forward = forward
+        self._port = port
+        self._listener = None
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        try:
+            self._listener = socket.create_server(('localhost', self._port))
+        except OSError as e:
+            raise ProcessException(f'Error: cannot listen on gdb_tunnel_port {self._port}: {e.strerror}')
+        threading.Thread(target=self._accept, name='gdb-tunnel', daemon=True).start()
+        return self
+
+    def __exit__(self, *_exc):
+        # a thread blocked in accept() keeps a closed socket listening
+        with contextlib.suppress(OSError):
+            self._listener.shutdown(socket.SHUT_RDWR)
+        self._listener.close()
+        with self._lock:
+            for sock in self._connections:
+                # wakes the thread reading from it
+                with contextlib.suppress(OSError):
+                    sock.shutdown(socket.SHUT_RDWR)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _addr = self._listener.accept()
+            except OSError:
+                return  # closed
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                self._connections.add(sock)
+            threading.Thread(target=self._run, args=(sock,), name='gdb-tunnel-connection', daemon=True).start()
+
+    def _run(self, sock):
+        try:
+            self._forward(sock)
+        finally:
+            with self._lock:
+                self._connections.discard(sock)
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
@@ -0,0 +1,125 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+import os
+import re
+import hashlib
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from collections import Counter
+
+_LOGGER = logging.getLogger(__name__)
+
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+
+class ImageCacheException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def file_digest(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while chunk := f.read(65536):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ImageCache:
+    """On-disk store of firmware images keyed by SHA-256, evicted least recently used first.
+    Images held by a request (see release()) are not evicted."""
+
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._held = Counter()  # file name -> requests holding it
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _file(self, digest):
+        if not _DIGEST.fullmatch(digest):
+            raise ImageCacheException(f"Error: invalid image digest: '{digest}'")
+        return self.path / f'{digest}.elf'
+
+    def lookup(self, digest, hold=False):
+        """Returns the path of a cached image, None if it is not cached. With 'hold' it is kept
+        until release()."""
+        file = self._file(digest)
+        with self._lock:
+            try:
+                os.utime(file)
+            except FileNotFoundError:
+                return None
+            if hold:
+                self._held[file.name] += 1
+        _LOGGER.info(f"Image cache hit: {digest}")
+        return file
+
+    async def store(self, chunks, digest='', hold=False):
+        """Writes the image from an async iterator of chunks to the store. Returns the path of the cached file,
+        with 'hold' it is kept until release()."""
+        h = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                async for data in chunks:
+                    h.update(data)
+                    f.write(data)
+            if digest and digest != h.hexdigest():
+                raise ImageCacheException("Error: uploaded image does not match digest.")
+            file = self._file(h.hexdigest())
+            with self._lock:
+                os.replace(tmp, file)
+                if hold:
+                    self._held[file.name] += 1
+                self._evict(file)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return file
+
+    def release(self, file):
+        """Ends a hold of lookup() or store(), e.g. when the image is programmed."""
+        name = Path(file).name
+        with self._lock:
+            self._held[name] -= 1
+            if self._held[name] <= 0:
+                del self._held[name]
+
+    def _state(self, target):
+        return self.path / f'last-{target}'
+
+    def programmed(self, target):
+        """Returns the cached image last programmed on the target, or None if unknown."""
+        try:
+            digest = self._state(target).read_text().strip()
+        except FileNotFoundError:
+            return None
+        return self.lookup(digest)
+
+    def set_programmed(self, target, file):
+        if file is None:
+            self._state(target).unlink(missing_ok=True)
+        else:
+            self._state(target).write_text(Path(file).stem)
+
+    def _evict(self, keep):
+        # images last programmed on a target are kept for delta flashing
+        pinned = {f'{s.read_text().strip()}.elf' for s in self.path.glob('last-*')}
+        files = [(f.stat(), f) for f in self.path.glob('*.elf')]
+        total = sum(st.st_size for st, _ in files)
+        for st, f in sorted(files, key=lambda x: x[0].st_mtime):
+            if total <= self.max_size:
+                break
+            if f != keep and f.name not in pinned and f.name not in self._held:
+                _LOGGER.info(f"Image cache evict: {f.name}")
+                f.unlink()
+                total -= st.st_size
@@ -0,0 +1,114 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Decoder for the ARMv7-M ITM packet protocol (ARMv7-M ARM, appendix D4).
+# Expects the raw ITM stream, i.e. TPIU output with the formatter disabled.
+#
+import time
+from collections import namedtuple
+
+ItmLine = namedtuple('ItmLine', ['port', 'timestamp', 'data'])
+
+_SIZES = (0, 1, 2, 4)
+_OVERFLOW = 0x70
+
+
+class ItmDecoder:
+    """Incremental ITM decoder. feed() takes raw trace data in blocks of any size and returns
+    complete lines of stimulus port output as ItmLine, tagged with port and host time.
+
+    Local timestamps are converted to host time if 'ts_freq' (the timestamp clock in Hz)
+    is given, relative to the host time the decoder saw its first data. Otherwise lines are
+    stamped with the host time they were decoded."""
+
+    def __init__(self, ports=None, ts_freq=0):
+        self.port_mask = 0xffffffff if not ports else sum(1 << p for p in ports if 0 <= p < 32)
+        self.ts_freq = ts_freq
+        self.overflows = 0
+        self._pending = b''
+        self._lines = {}
+        self._ticks = 0
+        self._t0 = None
+
+    def _now(self):
+        if self.ts_freq:
+            return self._t0 + self._ticks / self.ts_freq
+        return time.time()
+
+    def feed(self, data):
+        if self._t0 is None:
+            self._t0 = time.time()
+        buf = self._pending + data if self._pending else bytes(data)
+        size = len(buf)
+        mask = self.port_mask
+        lines = self._lines
+        out = []
+        i = 0
+        while i < size:
+            header = buf[i]
+            ss = header & 0x03
+            if ss:
+                # source packet, software (stimulus port) if bit 2 is clear
+                n = _SIZES[ss]
+                if i + 1 + n > size:
+                    break
+                port = header >> 3
+                if not header & 0x04 and mask >> port & 1:
+                    line = lines.get(port)
+                    if line is None:
+                        line = lines[port] = [bytearray(), 0.0]
+                    if not line[0]:
+                        line[1] = self._now()
+                    payload = buf[i + 1:i + 1 + n]
+                    line[0] += payload
+                    if b'\n' in payload:
+                        self._split(port, line, out)
+                i += 1 + n
+            elif header & 0x0f == 0:
+                if header == 0x00 or header == 0x80 or header == _OVERFLOW:
+                    # sync packet bytes, overflow
+                    if header == _OVERFLOW:
+                        self.overflows += 1
+                    i += 1
+                elif header & 0x80 == 0:
+                    # local timestamp format 2, no payload
+                    self._ticks += header >> 4
+                    i += 1
+                else:
+                    # local timestamp format 1, up to 4 payload bytes
+                    j, value, shift = i + 1, 0, 0
+                    while j < size and j - i <= 4:
+                        value |= (buf[j] & 0x7f) << shift
+                        shift += 7
+                        j += 1
+                        if not buf[j - 1] & 0x80:
+                            break
+                    else:
+                        if j - i <= 4:
+                            break
+                    self._ticks += value
+                    i = j
+            else:
+                # extension and global timestamp packets, payload bytes have bit 7 set if more follow
+                j = i + 1
+                if header & 0x80:
+                    while j < size and buf[j] & 0x80:
+                        j += 1
+                    if j >= size:
+                        break
+                    j += 1
+                i = j
+        self._pending = buf[i:]
+        return out
+
+    @staticmethod
+    def _split(port, line, out):
+        data, stamp = line
+        end = data.rfind(b'\n') + 1
+        for chunk in bytes(data[:end]).splitlines(keepends=True):
+            out.append(ItmLine(port, stamp, chunk))
+        del data[:end]
@@ -0,0 +1,156 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Queue of the operations on one device. Interactive jobs run before batch (CI) jobs, jobs of
+# the same priority are taken round robin from the waiting clients, so a client queueing many
+# jobs does not hold up the others. Runs in the event loop of the server.
+#
+import asyncio
+import itertools
+import contextlib
+from collections import deque
+from time import monotonic
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+# seconds between ETA updates to waiting jobs
+_UPDATE_INTERVAL = 1.0
+# weight of the last duration in the estimate of a kind of job
+_SMOOTHING = 0.3
+
+
+class JobQueueException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class Job:
+    def __init__(self, client, priority, kind, deadline, seq):
+        self.client = client
+        self.priority = priority
+        self.kind = kind
+        # monotonic() time the job must be done by, None for no deadline
+        self.deadline = deadline
+        self.seq = seq
+        self.started = None
+        self._changed = asyncio.Event()
+
+
+class JobQueue:
+    """Runs one job at a time, see wait() and done()."""
+
+    def __init__(self):
+        self.running = None
+        # client the device is reserved for between jobs, e.g. during its debug session
+        self.reserved_by = None
+        self._waiting = []
+        self._seq = itertools.count()
+        self._served = {}  # client -> grant number of its last job
+        self._grants = itertools.count()
+        self._durations = {}  # kind -> estimated seconds
+
+    def job(self, client, priority=PRIORITY_INTERACTIVE, kind='', timeout=None):
+        """Queues a job of 'client', 'timeout' is the time left until its deadline in seconds."""
+        deadline = None if timeout is None else monotonic() + timeout
+        job = Job(client, priority, kind, deadline, next(self._seq))
+        self._waiting.append(job)
+        self._notify()
+        return job
+
+    async def wait(self, job):
+        """Yields (position, eta) while 'job' waits, when they change or at least every second.
+        Position 1 is next, 'eta' is the estimated seconds until the job starts, None if unknown.
+        Returns when the job may run. Raises JobQueueException if it would miss its deadline."""
+        last = None
+        while True:
+            order = self._order()
+            blocked = self.reserved_by is not None and job.client != self.reserved_by
+            if self.running is None and order[0] is job and not blocked:
+                self._start(job)
+                return
+            position = order.index(job) + 1
+            # a reservation lasts as long as its client wants
+            eta = None if blocked else self._eta(order[:position - 1])
+            if eta is not None and job.deadline is not None:
+                duration = self._durations.get(job.kind, 0.0)
+                if monotonic() + eta + duration > job.deadline:
+                    raise JobQueueException(f'Error: device busy, position {position} in queue, '
+                                            f'would not finish before the deadline.')
+            if (position, eta if eta is None else round(eta)) != last:
+                last = position, eta if eta is None else round(eta)
+                yield position, eta
+            job._changed.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(job._changed.wait(), _UPDATE_INTERVAL)
+
+    def done(self, job):
+        """Removes 'job' from the queue, waiting or running."""
+        if job is self.running:
+            duration = monotonic() - job.started
+            estimate = self._durations.get(job.kind)
+            self._durations[job.kind] = duration if estimate is None else \
+                estimate + _SMOOTHING * (duration - estimate)
+            self.running = None
+        elif job in self._waiting:
+            self._waiting.remove(job)
+        self._notify()
+
+    def reserve(self, client):
+        """Only jobs of 'client' run until reserve(None)."""
+        self.reserved_by = client
+        self._notify()
+
+    def waiting(self):
+        return len(self._waiting)
+
+    def _start(self, job):
+        self._waiting.remove(job)
+        self._served[job.client] = next(self._grants)
+        job.started = monotonic()
+        self.running = job
+        self._notify()
+
+    def _notify(self):
+        for job in self._waiting:
+            job._changed.set()
+
+    def _order(self):
+        """Returns the waiting jobs in the order they run if no other jobs arrive."""
+        order = []
+        served = dict(self._served)
+        grant = itertools.count(max(served.values(), default=0) + 1)
+        for priority in sorted({job.priority for job in self._waiting}):
+            pending = {}
+            for job in self._waiting:
+                if job.priority == priority:
+                    pending.setdefault(job.client, deque()).append(job)
+            while pending:
+                # the client served longest ago, or never, goes first
+                client = min(pending, key=lambda c: (served.get(c, -1), pending[c][0].seq))
+                order.append(pending[client].popleft())
+                served[client] = next(grant)
+                if not pending[client]:
+                    del pending[client]
+        if self.reserved_by is not None:
+            order.sort(key=lambda job: job.client != self.reserved_by)
+        return order
+
+    def _eta(self, ahead):
+        """Returns the seconds until the jobs 'ahead' and the running job are done, None if unknown."""
+        eta = 0.0
+        if self.running is not None:
+            estimate = self._durations.get(self.running.kind)
+            if estimate is None:
+                return None
+            eta += max(estimate - (monotonic() - self.running.started), 0.0)
+        for job in ahead:
+            estimate = self._durations.get(job.kind)
+            if estimate is None:
+                return None
+            eta += estimate
+        return eta
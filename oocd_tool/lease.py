@@ -0,0 +1,57 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Debug sessions on oocd-rpcd are leased: the client renews the lease while gdb runs, a client
+# gone without calling StopDebug (suspended, disconnected) frees the device when it expires.
+#
+import sys
+import threading
+import contextlib
+
+# renewals per TTL, a lost renewal or two is tolerated
+_RENEWALS = 3
+
+
+class _Renewal(threading.Thread):
+    def __init__(self, renew, lease_id, ttl):
+        super().__init__(name='lease-renewal', daemon=True)
+        self._renew = renew
+        self._lease_id = lease_id
+        self._interval = ttl / _RENEWALS
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.wait(self._interval):
+            ttl = self._renew(self._lease_id)
+            if ttl == 0:
+                sys.stderr.write('Warning: the debug session has ended on the server (lease expired or device '
+                                 'taken over).\n')
+                return
+            if ttl is not None:
+                self._interval = ttl / _RENEWALS
+
+    def stop(self):
+        self._stop.set()
+
+
+@contextlib.contextmanager
+def debug_session(client):
+    """Runs the body in a debug session of 'client' (ClientChannel or AgentClient), renewing its lease.
+    client.renew_debug() returns the new TTL in seconds, 0 if the lease has ended and None if the
+    server is not reachable."""
+    lease_id, ttl = client.start_debug()
+    renewal = None
+    # servers without leases return no lease
+    if lease_id and ttl > 0:
+        renewal = _Renewal(client.renew_debug, lease_id, ttl)
+        renewal.start()
+    try:
+        yield
+    finally:
+        if renewal is not None:
+            renewal.stop()
+        client.stop_debug(lease_id)
@@ -0,0 +1,260 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+import asyncio
+import logging
+import threading
+from collections import deque
+from time import monotonic
+from oocd_tool.tail import FileTail, LineSplitter
+
+_LOGGER = logging.getLogger(__name__)
+
+_BUFFER_SIZE = 1 << 20
+_QUEUE_SIZE = 1 << 20
+_RETENTION = 60.0
+_MAX_SUBSCRIBERS = 256
+
+# what happens to subscribers falling more than their queue size behind
+LAG_DROP = 'drop'
+LAG_DISCONNECT = 'disconnect'
+
+
+class LogBufferException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class Subscriber:
+    """Bounded queue of the lines of a LogSource for one reader. If the reader falls more
+    than 'max_bytes' behind, the oldest lines are dropped and reported as lost (LAG_DROP),
+    or the next read() raises LogBufferException (LAG_DISCONNECT)."""
+
+    def __init__(self, source, max_bytes, policy):
+        self.source = source
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.lagging = False
+        self._lines = deque()  # (end offset, line)
+        self._size = 0
+        self._lost = 0
+        self._ready = asyncio.Event()
+
+    async def read(self, timeout=None):
+        """Returns (lost, lines) with the queued lines as list of (end offset, line), 'lost' is
+        the number of bytes dropped before them. Returns (0, []) on timeout or if the source closed."""
+        if not (self._lines or self.lagging or self.source.closed):
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return 0, []
+        if self.lagging:
+            raise LogBufferException(f"Error: log stream of '{self.source.filename}' fell too far behind.")
+        lines = list(self._lines)
+        lost = self._lost
+        self._lines.clear()
+        self._size = self._lost = 0
+        return lost, lines
+
+    def _put(self, lines):
+        self._ready.set()
+        if self.lagging:
+            return
+        for entry in lines:
+            self._lines.append(entry)
+            self._size += len(entry[1])
+        if self._size <= self.max_bytes:
+            return
+        if self.policy == LAG_DISCONNECT:
+            self.lagging = True
+            self._lines.clear()
+            self._size = 0
+            return
+        while self._size > self.max_bytes and len(self._lines) > 1:
+            _end, line = self._lines.popleft()
+            self._size -= len(line)
+            self._lost += len(line)
+
+
+class LogSource:
+    """Follows a log file in a task and keeps the most recent lines in a ring buffer of
+    'max_bytes'. New lines are queued for all subscribers, the reader never waits for them.
+    Lines are addressed by stream offset, the number of bytes read from the file up to the
+    end of the line, so readers can resume after a reconnect.
+    The source stops when it had no subscribers for 'retention' seconds."""
+
+    def __init__(self, filename, max_bytes=_BUFFER_SIZE, retention=_RETENTION):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.closed = False
+        self.subscribers = []
+        self._lines = deque()  # (end offset, line)
+        self._size = 0
+        self._offset = 0
+        self._idle_since = monotonic()
+        self._caught_up = asyncio.Event()
+        self._tail = FileTail(filename)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    @property
+    def offset(self):
+        return self._offset
+
+    async def wait_caught_up(self, timeout):
+        """Waits until the file was read up to its end once, or the source closed."""
+        try:
+            await asyncio.wait_for(self._caught_up.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def subscribe(self, offset, max_bytes=_QUEUE_SIZE, policy=LAG_DROP):
+        """Returns a Subscriber starting with the buffered lines after stream offset 'offset',
+        None if the source is already closed."""
+        if self.closed:
+            return None
+        subscriber = Subscriber(self, max_bytes, policy)
+        lost, lines = self._since(offset)
+        # the backlog is trimmed to the queue size, never a reason to disconnect
+        size = sum(len(line) for _end, line in lines)
+        while size > max_bytes and len(lines) > 1:
+            line = lines.popleft()[1]
+            size -= len(line)
+            lost += len(line)
+        if not offset:
+            # a new stream starts at the oldest buffered line, nothing it had is lost
+            lost = 0
+        subscriber._lines = lines
+        subscriber._size = size
+        subscriber._lost = lost
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.remove(subscriber)
+        self._idle_since = monotonic()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def _since(self, offset):
+        lines = deque()
+        for entry in reversed(self._lines):
+            if entry[0] <= offset:
+                break
+            lines.appendleft(entry)
+        if not lines:
+            return 0, lines
+        start = lines[0][0] - len(lines[0][1])
+        return max(start - offset, 0), lines
+
+    async def _run(self):
+        splitter = LineSplitter()
+        try:
+            while not self._expired():
+                data = await self._tail.read(1.0)
+                if not data:
+                    self._caught_up.set()
+                lines = splitter.feed(data)
+                if lines:
+                    self._append(lines)
+        except OSError as e:
+            _LOGGER.error(f"Reading '{self.filename}' failed: {e}")
+        finally:
+            self.closed = True
+            self._caught_up.set()
+            for subscriber in self.subscribers:
+                subscriber._ready.set()
+            self._tail.close()
+            _LOGGER.debug(f"Log source '{self.filename}' closed.")
+
+    def _expired(self):
+        return not self.subscribers and monotonic() - self._idle_since > self.retention
+
+    def _append(self, lines):
+        entries = []
+        for line in lines:
+            self._offset += len(line)
+            self._size += len(line)
+            entries.append((self._offset, line))
+        self._lines.extend(entries)
+        while self._size > self.max_bytes and len(self._lines) > 1:
+            self._size -= len(self._lines.popleft()[1])
+        for subscriber in self.subscribers:
+            subscriber._put(entries)
+
+
+class LogSources:
+    """One LogSource per log file, shared by all streams of the file. At most
+    'max_subscribers' streams are served at once. Runs in the event loop of the server, the
+    lock only guards the metrics read from other threads."""
+
+    def __init__(self, max_bytes=_BUFFER_SIZE, retention=_RETENTION, queue_size=_QUEUE_SIZE, policy=LAG_DROP,
+                 max_subscribers=_MAX_SUBSCRIBERS):
+        if policy not in (LAG_DROP, LAG_DISCONNECT):
+            raise LogBufferException(f"Error: invalid log lag policy: '{policy}'")
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.queue_size = queue_size
+        self.policy = policy
+        self.max_subscribers = max_subscribers
+        self._sources = {}
+        self._subscribing = 0
+        self._lock = threading.Lock()
+
+    async def subscribe(self, filename, resume_from=0):
+        """Returns a Subscriber to 'filename' starting after stream offset 'resume_from'."""
+        with self._lock:
+            for name in [name for name, source in self._sources.items() if source.closed]:
+                del self._sources[name]
+            # streams waiting for their source to catch up count as well
+            if self._subscriber_count() + self._subscribing >= self.max_subscribers:
+                raise LogBufferException('Error: too many log streams.')
+            source = self._sources.get(filename)
+            if source is None:
+                source = self._sources[filename] = LogSource(filename, self.max_bytes, self.retention)
+                source.start()
+            self._subscribing += 1
+        try:
+            await source.wait_caught_up(1.0)
+            if resume_from > source.offset:
+                # file truncated or replaced since the client's last stream
+                resume_from = 0
+            subscriber = source.subscribe(resume_from, self.queue_size, self.policy)
+        finally:
+            with self._lock:
+                self._subscribing -= 1
+        if subscriber is None:
+            raise LogBufferException(f"Error: log source '{filename}' closed.")
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscriber.source.unsubscribe(subscriber)
+
+    def subscriber_count(self):
+        with self._lock:
+            return self._subscriber_count()
+
+    def _subscriber_count(self):
+        return sum(len(source.subscribers) for source in self._sources.values())
+
+    def queued_bytes(self):
+        """Returns the number of bytes queued for all subscribers."""
+        with self._lock:
+            sources = list(self._sources.values())
+        return sum(subscriber._size for source in sources for subscriber in list(source.subscribers))
+
+    def close(self):
+        with self._lock:
+            for source in self._sources.values():
+                source.close()
+            self._sources.clear()
@@ -0,0 +1,80 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+import re
+from collections import deque
+from operator import itemgetter
+from time import monotonic
+
+
+class LogFilterException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def _compile(pattern):
+    if not pattern:
+        return None
+    try:
+        return re.compile(pattern.encode())
+    except re.error as e:
+        raise LogFilterException(f"Error: invalid regular expression '{pattern}': {e}")
+
+
+class LineFilter:
+    """Selects the lines of a log stream: lines matching 'include' and not matching 'exclude',
+    with up to 'context' lines before and after each of them. At most 'rate_limit' lines per
+    second are passed (0 for no limit), bursts of up to one second of lines are allowed."""
+
+    def __init__(self, include='', exclude='', context=0, rate_limit=0):
+        self._include = _compile(include)
+        self._exclude = _compile(exclude)
+        self.context = context
+        self.rate_limit = rate_limit
+        self._before = deque(maxlen=context)
+        self._after = 0
+        self._tokens = float(rate_limit)
+        self._last = monotonic()
+
+    def filter(self, entries, line=itemgetter(1)):
+        """Returns (passed, suppressed) for a list of entries, 'line' gets the line (bytes) of an entry.
+        'suppressed' is the number of selected lines dropped by the rate limit."""
+        include, exclude = self._include, self._exclude
+        if include is None and exclude is None:
+            selected = entries
+        else:
+            selected = []
+            for entry in entries:
+                text = line(entry)
+                if (include is None or include.search(text)) and (exclude is None or not exclude.search(text)):
+                    selected.extend(self._before)
+                    self._before.clear()
+                    selected.append(entry)
+                    self._after = self.context
+                elif self._after:
+                    selected.append(entry)
+                    self._after -= 1
+                elif self.context:
+                    self._before.append(entry)
+        return self._limit(selected)
+
+    def _limit(self, entries):
+        if not self.rate_limit:
+            return entries, 0
+        now = monotonic()
+        self._tokens = min(self._tokens + (now - self._last) * self.rate_limit, float(self.rate_limit))
+        self._last = now
+        n = min(len(entries), int(self._tokens))
+        self._tokens -= n
+        return entries[:n], len(entries) - n
+
+
+def line_filter(include='', exclude='', context=0, rate_limit=0):
+    """Returns a LineFilter, None if nothing is filtered."""
+    if not (include or exclude or rate_limit):
+        return None
+    return LineFilter(include, exclude, context, rate_limit)
@@ -10,12 +10,11 @@ import re
 import sys
 import signal
 import argparse
-import tempfile
-import oocd_tool.rpc_client as rpc_client
-from time import sleep
+from datetime import datetime
 from configparser import ConfigParser, ExtendedInterpolation
 from pathlib import PurePath, Path
 from oocd_tool.process import *
+from oocd_tool.readiness import ReadyCheck
 
 
 def signal_handler(_sig, _frame):
@@ -43,7 +42,39 @@ def parse_config(file, section):
         yield node
 
 
-def translate(nodes, **options):
+_RUN_TAGS = ('@ELFFILE@', '@TMPFILE@', '@FCPU@')
+
+
+def compile_section(nodes, config_path):
+    """Resolves @CONFIG@ and the config files of a section, the per-run tags in _RUN_TAGS are
+    left in place. Returns (nodes, files) as dicts."""
+    res_nodes = {}
+    files = {}
+    for key, value in nodes:
+        value = re.sub(r'@CONFIG@', config_path, value)
+        if re.match(r'config\..+', key):
+            files[f'@{key}@'] = value
+        else:
+            res_nodes[key] = value
+
+    # Append path to config keys there only contains filename, files given by a per-run tag are used as is
+    path = res_nodes['config_path'] if 'config_path' in res_nodes else config_path
+    for key, file in files.items():
+        if file.count('/') == 0 and not any(tag in file for tag in _RUN_TAGS):
+            files[key] = str(PurePath(PurePath(path), PurePath(file)))
+
+    # Replace @config@ tags with real path
+    expr = re.compile(r'@config\.[a-z0-9]+@')
+    for key, item in res_nodes.items():
+        tags = expr.findall(item)
+        for tag in tags:
+            item = item.replace(tag, files[tag])
+        res_nodes[key] = item
+    return res_nodes, files
+
+
+def apply_run_options(nodes, files, **options):
+    """Returns the configuration of a compiled section with @ELFFILE@, @TMPFILE@ and @FCPU@ replaced."""
     class Result:
         def __init__(self):
             self.has_tmpfile = False
@@ -63,11 +94,13 @@ def translate(nodes, **options):
     res = Result()
 
     counter = 0
-    for key, value in nodes:
-        value = re.sub(r'@CONFIG@', options['config'], value)
+
+    def substitute(value):
+        nonlocal counter
         value = re.sub(r'@ELFFILE@', options['elf'], value)
         if value.find('@TMPFILE@') != -1:
             if counter == 0:
+                import tempfile
                 res.tmpfile = tempfile.NamedTemporaryFile()
                 value = re.sub(r'@TMPFILE@', res.tmpfile.name, value)
                 res.has_tmpfile = True
@@ -80,49 +113,51 @@ def translate(nodes, **options):
             if options['fcpu'] is None:
                 raise ConfigException('Error: --fcpu is missing.')
             value = re.sub(r'@FCPU@', str(options['fcpu']), value)
-        if re.match(r'config\..+', key):
-            res.files[f'@{key}@'] = value
-        else:
-            res.nodes[key] = value
-
-    # Append path to config keys there only contains filename
-    path = res.nodes['config_path'] if 'config_path' in res.nodes else options['config_path']
-    for key, file in res.files.items():
-        res.files[key] = file if file.count('/') != 0 else str(PurePath(PurePath(path), PurePath(file)))
+        return value
 
-    # Replace @config@ tags with real path
-    expr = re.compile(r'@config\.[a-z0-9]+@')
-    for key, item in res.nodes.items():
-        tags = expr.findall(item)
-        for tag in tags:
-            item = item.replace(tag, res.files[tag])
-        res.nodes[key] = item
+    for key, file in files.items():
+        res.files[key] = substitute(file)
+    for key, value in nodes.items():
+        res.nodes[key] = substitute(value)
     return res
 
 
+def translate(nodes, **options):
+    return apply_run_options(*compile_section(nodes, options['config']), elf=options['elf'], fcpu=options['fcpu'])
+
+
+def is_remote(config):
+    return 'openocd_remote' in config or 'openocd_remotes' in config
+
+
 def check_mandatory_keys(config, key_list):
     for key in key_list:
         if key not in config:
-            if not (key == 'openocd_executable' and 'openocd_remote' in config):
+            if not (key == 'openocd_executable' and is_remote(config)):
                 raise ConfigException(f'Error: missing configuration entry: {key}')
 
 
-def check_executable(file):
-    import shutil
-    if shutil.which(file) is None:
+def check_executable(file, which=None):
+    if which is None:
+        import shutil
+        which = shutil.which
+    if which(file) is None:
         raise ConfigException(f'Error: executable not found: {file}')
 
 
-def validate_configuration(config, section):
+def validate_configuration(config, section, which=None):
     if 'mode' not in config or config.mode not in ['gdb_openocd', 'openocd', 'gdb']:
         raise ConfigException(f'Error: mode not specified in section: [{section}]')
     if config.mode == 'gdb':
         check_mandatory_keys(config, ['gdb_executable', 'gdb_args'])
-        check_executable(config.gdb_executable)
+        check_executable(config.gdb_executable, which)
     if config.mode != 'gdb':
         check_mandatory_keys(config, ['openocd_executable', 'openocd_args'])
-        if 'openocd_remote' not in config:
-            check_executable(config.openocd_executable)
+        if not is_remote(config):
+            check_executable(config.openocd_executable, which)
+    if 'openocd_remotes' in config and 'openocd_remote' not in config and config.mode != 'openocd':
+        # debug sessions run on one host
+        raise ConfigException(f"Error: 'openocd_remotes' requires mode 'openocd' in section: [{section}]")
 
 
 def validate_files(files):
@@ -145,17 +180,53 @@ def default_config_file():
     return path
 
 
-def raise_if_running(filename):
-    running, pid = is_process_running(filename)
+def raise_if_running(cfg):
+    running, pid = is_process_running(cfg.openocd_executable)
     if running:
         raise ProcessException(f'Error: openocd is already running with pid: {pid}')
+    # openocd not started by oocd-tool, default gdb, telnet and tcl ports
+    port = port_in_use(int(port) for port in cfg.nodes.get('openocd_ports', '3333 4444 6666').split())
+    if port:
+        raise ProcessException(f'Error: port {port} in use, openocd is already running?')
+
+
+def upload_image(cfg, file):
+    """Returns the file to upload, ELF files are stripped to their loadable segments."""
+    if cfg.nodes.get('strip_elf', 'enabled') == 'disabled':
+        return file
+    from oocd_tool.elf import ElfException, stripped_image
+    try:
+        return stripped_image(file, Path(Path.home(), '.oocd-tool', 'cache'))
+    except ElfException:
+        return file
+
+
+def queue_options(cfg):
+    """Returns (priority, deadline) of the device operations, see oocd-rpcd job queue."""
+    priority = cfg.nodes.get('priority', 'interactive')
+    if priority not in ('interactive', 'batch'):
+        raise ConfigException(f"Error: invalid priority: '{priority}', expected 'interactive' or 'batch'.")
+    return priority, float(cfg.nodes['deadline']) if 'deadline' in cfg.nodes else None
+
 
+def _itm_prefix(port, timestamp):
+    stamp = datetime.fromtimestamp(timestamp).strftime('%H:%M:%S.%f') if timestamp else '-'
+    return f'{stamp} [{port}] '.encode()
 
-def run_openocd_remote(rpc, args):
+
+def log_filters(cfg):
+    """Returns the server-side log filter options of a section."""
+    return {'include': cfg.nodes.get('log_include', ''), 'exclude': cfg.nodes.get('log_exclude', ''),
+            'context': int(cfg.nodes.get('log_context', '0')),
+            'rate_limit': int(cfg.nodes.get('log_rate_limit', '0'))}
+
+
+def run_openocd_remote(rpc, args, log_batch_interval=5, prepare=lambda file: file, itm_ports=(), itm_ts_freq=0,
+                       filters=None):
     n = args.find(' ')
     cmd = args if n == -1 else args[0: n]
     if cmd == 'program' and n != -1:
-        stream = rpc.program_device(args[len(cmd) + 1:])
+        stream = rpc.program_device(prepare(args[len(cmd) + 1:]))
         for line in stream:
             print(line)
     elif cmd == 'reset':
@@ -163,13 +234,36 @@ def run_openocd_remote(rpc, args):
         for line in stream:
             print(line)
     elif cmd == 'logstream' and n != -1:
-        stream = rpc.log_stream_create(args[len(cmd) + 1:])
-        for line in stream:
-            print(line)
+        stream = rpc.log_stream_blocks(args[len(cmd) + 1:], log_batch_interval, **(filters or {}))
+        for block in stream:
+            sys.stdout.buffer.write(block)
+            sys.stdout.flush()
+    elif cmd == 'itmstream' and n != -1:
+        stream = rpc.log_stream_itm(args[len(cmd) + 1:], itm_ports, itm_ts_freq, log_batch_interval,
+                                    **(filters or {}))
+        for port, timestamp, block in stream:
+            prefix = _itm_prefix(port, timestamp)
+            sys.stdout.buffer.write(b''.join(prefix + line for line in block.splitlines(keepends=True)))
+            sys.stdout.flush()
     else:
         raise ConfigException(f'Error: invalid rpc mode: {args}')
 
 
+def run_openocd_fleet(targets, tls, auth_key, args, prepare=lambda file: file, priority='interactive',
+                      deadline=None):
+    import oocd_tool.rpc_client_as as rpc_client_as
+    n = args.find(' ')
+    cmd = args if n == -1 else args[0: n]
+    if not (cmd == 'program' and n != -1) and cmd != 'reset':
+        raise ConfigException(f'Error: invalid rpc mode for openocd_remotes: {args}')
+    channel = rpc_client_as.secure_channel if tls else rpc_client_as.insecure_channel
+    file = prepare(args[len(cmd) + 1:]) if cmd == 'program' else None
+    failed = rpc_client_as.run_fleet(targets, channel, auth_key, cmd, file, priority=priority, deadline=deadline)
+    print(f'{cmd}: {len(targets) - len(failed)}/{len(targets)} targets succeeded')
+    if failed:
+        raise ProcessException(f'Error: {cmd} failed on: {", ".join(failed)}')
+
+
 class LocalExecuteInterface:
     def __init__(self):
         self.ocd = None
@@ -178,20 +272,20 @@ class LocalExecuteInterface:
         BackgroundProcess(cfg.spawn_process, '', True)
 
     def debug_spawned_openocd(self, cfg):
-        raise_if_running(cfg.openocd_executable)
-        self.ocd = BackgroundProcess(cfg.openocd_executable, cfg.openocd_args, False)
-        sleep(0.1)
-        if not self.ocd.is_running():
-            raise ProcessException(f'Error: openocd prematurely exited with code: {self.ocd.returncode()}')
+        raise_if_running(cfg)
+        self.ocd = BackgroundProcess(cfg.openocd_executable, cfg.openocd_args, False,
+                                     ReadyCheck.from_config(cfg.nodes))
+        # gdb is started as soon as openocd listens
+        self.ocd.wait_ready()
         BlockingProcess(cfg.gdb_executable, cfg.gdb_args)
         self.ocd.terminate()
 
     def debug(self, cfg):
-        raise_if_running(cfg.openocd_executable)
+        raise_if_running(cfg)
         BlockingProcess(cfg.gdb_executable, cfg.gdb_args)
 
     def openocd_only(self, cfg):
-        raise_if_running(cfg.openocd_executable)
+        raise_if_running(cfg)
         self.ocd = BackgroundProcess(cfg.openocd_executable, cfg.openocd_args, True)
         self.ocd.wait()
         pass
@@ -201,9 +295,26 @@ class LocalExecuteInterface:
 
 
 class RemoteExecuteInterface:
-    def __init__(self, channel, auth_key):
-        self.channel = channel
+    def __init__(self, tls, auth_key, verbose=False):
+        self.tls = tls
         self.auth_key = auth_key
+        self.verbose = verbose
+
+    def _client(self, cfg, direct=False):
+        chunk_max = int(cfg.nodes.get('upload_chunk_max', '256')) * 1024
+        priority, deadline = queue_options(cfg)
+        if not direct and cfg.nodes.get('agent', 'enabled') != 'disabled':
+            from oocd_tool import agent
+            path = Path(cfg.nodes.get('agent_socket', str(agent._SOCKET))).expanduser()
+            if agent.is_running(path):
+                return agent.AgentClient(path, cfg.openocd_remote, self.tls, self.auth_key,
+                                         cfg.nodes.get('root_ca', ''), cfg.nodes.get('device', ''), chunk_max,
+                                         self.verbose, priority, deadline)
+        import oocd_tool.rpc_client as rpc_client
+        rpc_client.load_certificates(cfg)
+        channel = rpc_client.secure_channel if self.tls else rpc_client.insecure_channel
+        return rpc_client.ClientChannel(cfg.openocd_remote, channel, self.auth_key, cfg.nodes.get('device', ''),
+                                        chunk_max, self.verbose, priority=priority, deadline=deadline)
 
     def spawn_process(self):
         # TODO
@@ -213,24 +324,41 @@ class RemoteExecuteInterface:
         raise ConfigException("Invalid mode configured.")
 
     def debug(self, cfg):
-        rpc = rpc_client.ClientChannel(cfg.openocd_remote, self.channel, self.auth_key)
-        with rpc.debug_device():
+        if 'gdb_tunnel_port' not in cfg.nodes:
+            rpc = self._client(cfg)
+            with rpc.debug_device():
+                BlockingProcess(cfg.gdb_executable, cfg.gdb_args)
+            return
+        # the debug session and the tunnel share one connection, the agent cannot tunnel
+        from oocd_tool.gdb_tunnel import GdbTunnel
+        rpc = self._client(cfg, direct=True)
+        # the listener is closed whatever fails after it
+        with GdbTunnel(rpc.gdb_tunnel, int(cfg.nodes['gdb_tunnel_port'])), rpc.connected(), rpc.debug_device():
             BlockingProcess(cfg.gdb_executable, cfg.gdb_args)
 
     def openocd_only(self, cfg):
-        rpc = rpc_client.ClientChannel(cfg.openocd_remote, self.channel, self.auth_key)
-        run_openocd_remote(rpc, cfg.openocd_args)
-
-
-def execute(cfg):
+        if 'openocd_remotes' in cfg:
+            import oocd_tool.rpc_client_as as rpc_client_as
+            rpc_client_as.load_certificates(cfg)
+            run_openocd_fleet(cfg.openocd_remotes.split(), self.tls, self.auth_key, cfg.openocd_args,
+                              lambda file: upload_image(cfg, file), *queue_options(cfg))
+            return
+        rpc = self._client(cfg)
+        itm_ports = [int(port) for port in cfg.nodes.get('itm_ports', '').split()]
+        run_openocd_remote(rpc, cfg.openocd_args, int(cfg.nodes.get('log_batch_interval', '5')),
+                           lambda file: upload_image(cfg, file), itm_ports, int(cfg.nodes.get('itm_ts_freq', '0')),
+                           log_filters(cfg))
+
+
+def execute(cfg, verbose=False):
     auth_key = ""
-    channel = rpc_client.secure_channel
-    if 'openocd_remote' in cfg:
+    tls = True
+    if is_remote(cfg):
         if 'tls_mode' in cfg and cfg.tls_mode == 'disabled':
-            channel = rpc_client.insecure_channel
+            tls = False
         else:
             auth_key = get_config_value(cfg, 'cert_auth_key', "Error: 'cert_signature_key' not specified.")
-        interface = RemoteExecuteInterface(channel, auth_key)
+        interface = RemoteExecuteInterface(tls, auth_key, verbose)
     else:
         interface = LocalExecuteInterface()
     if 'spawn_process' in cfg:
@@ -255,6 +383,7 @@ def main():
     parser.add_argument('-c', dest='config', nargs='?', metavar='CONFIG', help='config file')
     parser.add_argument('--fcpu', action='store', type=int, metavar='FREQ', help='cpu clock (used with itm logging)')
     parser.add_argument('-d', action='store_true', help='dry run')
+    parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
     args = parser.parse_args()
 
     create_default_config()
@@ -272,8 +401,12 @@ def main():
     # regex fails with windows path's. as_posix() used as workaround
     config_path = PurePath(args.config).parent.as_posix()
 
-    pc = parse_config(args.config, args.section)
-    cfg = translate(pc, config=config_path, elf=args.source, fcpu=args.fcpu)
+    # sections are compiled once per config file change, only the per-run tags are replaced on each run
+    from oocd_tool.config_cache import ConfigCache
+    cache = ConfigCache(Path(Path.home(), '.oocd-tool', 'cache'), args.config, config_path)
+    nodes, files = cache.section(args.section,
+                                 lambda: compile_section(parse_config(args.config, args.section), config_path))
+    cfg = apply_run_options(nodes, files, elf=args.source, fcpu=args.fcpu)
 
     # dry run
     if args.d:
@@ -284,12 +417,13 @@ def main():
             print(f'openocd: {cfg.openocd_executable} {cfg.openocd_args}\n')
         if 'spawn_process' in cfg.nodes:
             print(f'spawn: {cfg.spawn_process}\n')
+        cache.save()
         sys.exit(0)
 
-    validate_configuration(cfg, args.section)
+    validate_configuration(cfg, args.section, cache.which)
+    cache.save()
     validate_files(cfg.files)
-    rpc_client.load_certificates(cfg)
-    execute(cfg)
+    execute(cfg, args.verbose)
 
 
 if __name__ == "__main__":
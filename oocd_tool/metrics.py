@@ -0,0 +1,211 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Minimal metrics in the Prometheus text format, served over HTTP by oocd-rpcd.
+#
+import threading
+import logging
+from time import monotonic
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_LOGGER = logging.getLogger(__name__)
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_THROUGHPUT_BUCKETS = (1e4, 1e5, 5e5, 1e6, 2e6, 5e6, 1e7, 2e7, 5e7, 1e8)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, le=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f'{self.name}: expected labels {self.labels}')
+        return tuple(labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            lines += self._samples()
+        return lines
+
+    def _samples(self):
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}'
+                for key, value in sorted(self._values.items())]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Gauge set by the caller, or read from 'function' (returning {labels: value}) on render."""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def _samples(self):
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            self._values = values
+        return super()._samples()
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def _samples(self):
+        lines = []
+        for key, counts in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, bound)} {count}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, "+Inf")} {counts[-2]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {counts[-1]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {counts[-2]}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = monotonic()
+        return self
+
+    def __exit__(self, *_exc):
+        self._histogram.observe(monotonic() - self._start, *self._labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+RPC_REQUESTS = REGISTRY.register(Counter(
+    'oocd_rpc_requests_total', 'Finished RPCs by method and status code.', ('method', 'code')))
+RPC_LATENCY = REGISTRY.register(Histogram(
+    'oocd_rpc_duration_seconds', 'RPC duration, streaming RPCs until the stream ended.', ('method',)))
+UPLOAD_BYTES = REGISTRY.register(Counter(
+    'oocd_upload_bytes_total', 'Firmware bytes received, as sent and after decompression.', ('kind',)))
+UPLOAD_THROUGHPUT = REGISTRY.register(Histogram(
+    'oocd_upload_throughput_bytes_per_second', 'Firmware upload throughput (decompressed).', (),
+    _THROUGHPUT_BUCKETS))
+PROGRAM_PHASE = REGISTRY.register(Histogram(
+    'oocd_program_phase_seconds', 'Duration of the phases of ProgramDevice.', ('device', 'phase')))
+OPENOCD_SPAWN = REGISTRY.register(Histogram(
+    'oocd_openocd_spawn_seconds',
+    'Time to start an openocd process (debug: until ready, session: until the TCL port accepts).', ('command',)))
+OPENOCD_RUN = REGISTRY.register(Histogram(
+    'oocd_openocd_run_seconds', 'Run time of openocd commands until exit.', ('command',)))
+OPENOCD_EXIT = REGISTRY.register(Histogram(
+    'oocd_openocd_exit_seconds', 'Time for openocd to exit after being terminated.', ('command',)))
+OPENOCD_EXITS = REGISTRY.register(Counter(
+    'oocd_openocd_exits_total', 'openocd exits by command and return code.', ('command', 'returncode')))
+DEVICE_WAITING = REGISTRY.register(Gauge(
+    'oocd_device_queue_depth', 'Requests waiting for a busy device.', ('device',)))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _LOGGER.debug(format, *args)
+
+
+def start_http_server(bindto, registry=REGISTRY):
+    """Serves the metrics on http://<bindto>/metrics in a thread, 'bindto' is 'host:port'."""
+    host, _, port = bindto.rpartition(':')
+    server = ThreadingHTTPServer((host, int(port)), _Handler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -2,9 +2,9 @@
 # Generated by the protocol buffer compiler.  DO NOT EDIT!
 # source: openocd.proto
 """Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
 from google.protobuf import descriptor as _descriptor
-from google.protobuf import message as _message
-from google.protobuf import reflection as _reflection
+from google.protobuf import descriptor_pool as _descriptor_pool
 from google.protobuf import symbol_database as _symbol_database
 # @@protoc_insertion_point(imports)
 
@@ -13,237 +13,33 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor.FileDescriptor(
-  name='openocd.proto',
-  package='rpi',
-  syntax='proto3',
-  serialized_options=None,
-  create_key=_descriptor._internal_create_key,
-  serialized_pb=b'\n\ropenocd.proto\x12\x03rpi\"$\n\x10LogStreamRequest\x12\x10\n\x08\x66ilename\x18\x01 \x01(\t\"!\n\x11LogStreamResponse\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\t\"\x1e\n\x0eProgramRequest\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\"\x06\n\x04void2\x8a\x02\n\x07OpenOcd\x12@\n\rProgramDevice\x12\x13.rpi.ProgramRequest\x1a\x16.rpi.LogStreamResponse(\x01\x30\x01\x12\x32\n\x0bResetDevice\x12\t.rpi.void\x1a\x16.rpi.LogStreamResponse0\x01\x12\"\n\nStartDebug\x12\t.rpi.void\x1a\t.rpi.void\x12!\n\tStopDebug\x12\t.rpi.void\x1a\t.rpi.void\x12\x42\n\x0fLogStreamCreate\x12\x15.rpi.LogStreamRequest\x1a\x16.rpi.LogStreamResponse0\x01\x62\x06proto3'
-)
-
-
-
-
-_LOGSTREAMREQUEST = _descriptor.Descriptor(
-  name='LogStreamRequest',
-  full_name='rpi.LogStreamRequest',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  create_key=_descriptor._internal_create_key,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='filename', full_name='rpi.LogStreamRequest.filename', index=0,
-      number=1, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=b"".decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=22,
-  serialized_end=58,
-)
-
-
-_LOGSTREAMRESPONSE = _descriptor.Descriptor(
-  name='LogStreamResponse',
-  full_name='rpi.LogStreamResponse',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  create_key=_descriptor._internal_create_key,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='data', full_name='rpi.LogStreamResponse.data', index=0,
-      number=1, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=b"".decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=60,
-  serialized_end=93,
-)
-
-
-_PROGRAMREQUEST = _descriptor.Descriptor(
-  name='ProgramRequest',
-  full_name='rpi.ProgramRequest',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  create_key=_descriptor._internal_create_key,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='data', full_name='rpi.ProgramRequest.data', index=0,
-      number=1, type=12, cpp_type=9, label=1,
-      has_default_value=False, default_value=b"",
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=95,
-  serialized_end=125,
-)
-
-
-_VOID = _descriptor.Descriptor(
-  name='void',
-  full_name='rpi.void',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  create_key=_descriptor._internal_create_key,
-  fields=[
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=127,
-  serialized_end=133,
-)
-
-DESCRIPTOR.message_types_by_name['LogStreamRequest'] = _LOGSTREAMREQUEST
-DESCRIPTOR.message_types_by_name['LogStreamResponse'] = _LOGSTREAMRESPONSE
-DESCRIPTOR.message_types_by_name['ProgramRequest'] = _PROGRAMREQUEST
-DESCRIPTOR.message_types_by_name['void'] = _VOID
-_sym_db.RegisterFileDescriptor(DESCRIPTOR)
-
-LogStreamRequest = _reflection.GeneratedProtocolMessageType('LogStreamRequest', (_message.Message,), {
-  'DESCRIPTOR' : _LOGSTREAMREQUEST,
-  '__module__' : 'openocd_pb2'
-  # @@protoc_insertion_point(class_scope:rpi.LogStreamRequest)
-  })
-_sym_db.RegisterMessage(LogStreamRequest)
-
-LogStreamResponse = _reflection.GeneratedProtocolMessageType('LogStreamResponse', (_message.Message,), {
-  'DESCRIPTOR' : _LOGSTREAMRESPONSE,
-  '__module__' : 'openocd_pb2'
-  # @@protoc_insertion_point(class_scope:rpi.LogStreamResponse)
-  })
-_sym_db.RegisterMessage(LogStreamResponse)
-
-ProgramRequest = _reflection.GeneratedProtocolMessageType('ProgramRequest', (_message.Message,), {
-  'DESCRIPTOR' : _PROGRAMREQUEST,
-  '__module__' : 'openocd_pb2'
-  # @@protoc_insertion_point(class_scope:rpi.ProgramRequest)
-  })
-_sym_db.RegisterMessage(ProgramRequest)
-
-void = _reflection.GeneratedProtocolMessageType('void', (_message.Message,), {
-  'DESCRIPTOR' : _VOID,
-  '__module__' : 'openocd_pb2'
-  # @@protoc_insertion_point(class_scope:rpi.void)
-  })
-_sym_db.RegisterMessage(void)
-
-
-
-_OPENOCD = _descriptor.ServiceDescriptor(
-  name='OpenOcd',
-  full_name='rpi.OpenOcd',
-  file=DESCRIPTOR,
-  index=0,
-  serialized_options=None,
-  create_key=_descriptor._internal_create_key,
-  serialized_start=136,
-  serialized_end=402,
-  methods=[
-  _descriptor.MethodDescriptor(
-    name='ProgramDevice',
-    full_name='rpi.OpenOcd.ProgramDevice',
-    index=0,
-    containing_service=None,
-    input_type=_PROGRAMREQUEST,
-    output_type=_LOGSTREAMRESPONSE,
-    serialized_options=None,
-    create_key=_descriptor._internal_create_key,
-  ),
-  _descriptor.MethodDescriptor(
-    name='ResetDevice',
-    full_name='rpi.OpenOcd.ResetDevice',
-    index=1,
-    containing_service=None,
-    input_type=_VOID,
-    output_type=_LOGSTREAMRESPONSE,
-    serialized_options=None,
-    create_key=_descriptor._internal_create_key,
-  ),
-  _descriptor.MethodDescriptor(
-    name='StartDebug',
-    full_name='rpi.OpenOcd.StartDebug',
-    index=2,
-    containing_service=None,
-    input_type=_VOID,
-    output_type=_VOID,
-    serialized_options=None,
-    create_key=_descriptor._internal_create_key,
-  ),
-  _descriptor.MethodDescriptor(
-    name='StopDebug',
-    full_name='rpi.OpenOcd.StopDebug',
-    index=3,
-    containing_service=None,
-    input_type=_VOID,
-    output_type=_VOID,
-    serialized_options=None,
-    create_key=_descriptor._internal_create_key,
-  ),
-  _descriptor.MethodDescriptor(
-    name='LogStreamCreate',
-    full_name='rpi.OpenOcd.LogStreamCreate',
-    index=4,
-    containing_service=None,
-    input_type=_LOGSTREAMREQUEST,
-    output_type=_LOGSTREAMRESPONSE,
-    serialized_options=None,
-    create_key=_descriptor._internal_create_key,
-  ),
-])
-_sym_db.RegisterServiceDescriptor(_OPENOCD)
-
-DESCRIPTOR.services_by_name['OpenOcd'] = _OPENOCD
-
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\ropenocd.proto\x12\x03rpi\"\xdc\x01\n\x10LogStreamRequest\x12\x10\n\x08\x66ilename\x18\x01 \x01(\t\x12\x19\n\x11\x62\x61tch_interval_ms\x18\x02 \x01(\r\x12\x12\n\nbatch_size\x18\x03 \x01(\r\x12\x0b\n\x03itm\x18\x04 \x01(\x08\x12\r\n\x05ports\x18\x05 \x03(\r\x12\x0f\n\x07ts_freq\x18\x06 \x01(\r\x12\x13\n\x0bresume_from\x18\x07 \x01(\x04\x12\x0f\n\x07include\x18\x08 \x01(\t\x12\x0f\n\x07\x65xclude\x18\t \x01(\t\x12\x0f\n\x07\x63ontext\x18\n \x01(\r\x12\x12\n\nrate_limit\x18\x0b \x01(\r\"\xb1\x01\n\x11LogStreamResponse\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\t\x12\r\n\x05lines\x18\x02 \x01(\x0c\x12\x0c\n\x04port\x18\x03 \x01(\r\x12\x11\n\ttimestamp\x18\x04 \x01(\x01\x12\x0e\n\x06offset\x18\x05 \x01(\x04\x12\x0c\n\x04lost\x18\x06 \x01(\x04\x12\x12\n\nsuppressed\x18\x07 \x01(\x04\x12\x16\n\x0equeue_position\x18\x08 \x01(\r\x12\x14\n\x0cqueue_eta_ms\x18\t \x01(\r\"\x81\x01\n\x0eProgramRequest\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\x12\x0e\n\x06\x64igest\x18\x02 \x01(\t\x12\x0e\n\x06\x64\x65vice\x18\x03 \x01(\t\x12\x10\n\x08\x65ncoding\x18\x04 \x01(\t\x12\x1f\n\x08priority\x18\x05 \x01(\x0e\x32\r.rpi.Priority\x12\x0e\n\x06\x63lient\x18\x06 \x01(\t\"q\n\rDeviceRequest\x12\x0e\n\x06\x64\x65vice\x18\x01 \x01(\t\x12\x1f\n\x08priority\x18\x02 \x01(\x0e\x32\r.rpi.Priority\x12\x0e\n\x06\x63lient\x18\x03 \x01(\t\x12\r\n\x05lease\x18\x04 \x01(\x08\x12\x10\n\x08lease_id\x18\x05 \x01(\t\">\n\nDebugLease\x12\x0e\n\x06\x64\x65vice\x18\x01 \x01(\t\x12\x10\n\x08lease_id\x18\x02 \x01(\t\x12\x0e\n\x06ttl_ms\x18\x03 \x01(\r\"\x1e\n\x0cImageRequest\x12\x0e\n\x06\x64igest\x18\x01 \x01(\t\"2\n\rImageResponse\x12\x0e\n\x06\x63\x61\x63hed\x18\x01 \x01(\x08\x12\x11\n\tencodings\x18\x02 \x03(\t\"\'\n\x07GdbData\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\x12\x0e\n\x06\x64\x65vice\x18\x02 \x01(\t\"\x06\n\x04void*&\n\x08Priority\x12\x0f\n\x0bINTERACTIVE\x10\x00\x12\t\n\x05\x42\x41TCH\x10\x01\x32\xbd\x03\n\x07OpenOcd\x12@\n\rProgramDevice\x12\x13.rpi.ProgramRequest\x1a\x16.rpi.LogStreamResponse(\x01\x30\x01\x12;\n\x0bResetDevice\x12\x12.rpi.DeviceRequest\x1a\x16.rpi.LogStreamResponse0\x01\x12\x31\n\nStartDebug\x12\x12.rpi.DeviceRequest\x1a\x0f.rpi.DebugLease\x12.\n\nRenewDebug\x12\x0f.rpi.DebugLease\x1a\x0f.rpi.DebugLease\x12*\n\tStopDebug\x12\x12.rpi.DeviceRequest\x1a\t.rpi.void\x12\x42\n\x0fLogStreamCreate\x12\x15.rpi.LogStreamRequest\x1a\x16.rpi.LogStreamResponse0\x01\x12\x33\n\nQueryImage\x12\x11.rpi.ImageRequest\x1a\x12.rpi.ImageResponse\x12+\n\tGdbTunnel\x12\x0c.rpi.GdbData\x1a\x0c.rpi.GdbData(\x01\x30\x01\x62\x06proto3')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'openocd_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _PRIORITY._serialized_start=869
+  _PRIORITY._serialized_end=907
+  _LOGSTREAMREQUEST._serialized_start=23
+  _LOGSTREAMREQUEST._serialized_end=243
+  _LOGSTREAMRESPONSE._serialized_start=246
+  _LOGSTREAMRESPONSE._serialized_end=423
+  _PROGRAMREQUEST._serialized_start=426
+  _PROGRAMREQUEST._serialized_end=555
+  _DEVICEREQUEST._serialized_start=557
+  _DEVICEREQUEST._serialized_end=670
+  _DEBUGLEASE._serialized_start=672
+  _DEBUGLEASE._serialized_end=734
+  _IMAGEREQUEST._serialized_start=736
+  _IMAGEREQUEST._serialized_end=766
+  _IMAGERESPONSE._serialized_start=768
+  _IMAGERESPONSE._serialized_end=818
+  _GDBDATA._serialized_start=820
+  _GDBDATA._serialized_end=859
+  _VOID._serialized_start=861
+  _VOID._serialized_end=867
+  _OPENOCD._serialized_start=910
+  _OPENOCD._serialized_end=1355
 # @@protoc_insertion_point(module_scope)
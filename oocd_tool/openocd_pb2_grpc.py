@@ -21,17 +21,22 @@ class OpenOcdStub(object):
                 )
         self.ResetDevice = channel.unary_stream(
                 '/rpi.OpenOcd/ResetDevice',
-                request_serializer=openocd__pb2.void.SerializeToString,
+                request_serializer=openocd__pb2.DeviceRequest.SerializeToString,
                 response_deserializer=openocd__pb2.LogStreamResponse.FromString,
                 )
         self.StartDebug = channel.unary_unary(
                 '/rpi.OpenOcd/StartDebug',
-                request_serializer=openocd__pb2.void.SerializeToString,
-                response_deserializer=openocd__pb2.void.FromString,
+                request_serializer=openocd__pb2.DeviceRequest.SerializeToString,
+                response_deserializer=openocd__pb2.DebugLease.FromString,
+                )
+        self.RenewDebug = channel.unary_unary(
+                '/rpi.OpenOcd/RenewDebug',
+                request_serializer=openocd__pb2.DebugLease.SerializeToString,
+                response_deserializer=openocd__pb2.DebugLease.FromString,
                 )
         self.StopDebug = channel.unary_unary(
                 '/rpi.OpenOcd/StopDebug',
-                request_serializer=openocd__pb2.void.SerializeToString,
+                request_serializer=openocd__pb2.DeviceRequest.SerializeToString,
                 response_deserializer=openocd__pb2.void.FromString,
                 )
         self.LogStreamCreate = channel.unary_stream(
@@ -39,6 +44,16 @@ class OpenOcdStub(object):
                 request_serializer=openocd__pb2.LogStreamRequest.SerializeToString,
                 response_deserializer=openocd__pb2.LogStreamResponse.FromString,
                 )
+        self.QueryImage = channel.unary_unary(
+                '/rpi.OpenOcd/QueryImage',
+                request_serializer=openocd__pb2.ImageRequest.SerializeToString,
+                response_deserializer=openocd__pb2.ImageResponse.FromString,
+                )
+        self.GdbTunnel = channel.stream_stream(
+                '/rpi.OpenOcd/GdbTunnel',
+                request_serializer=openocd__pb2.GdbData.SerializeToString,
+                response_deserializer=openocd__pb2.GdbData.FromString,
+                )
 
 
 class OpenOcdServicer(object):
@@ -62,6 +77,12 @@ class OpenOcdServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def RenewDebug(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def StopDebug(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -74,6 +95,19 @@ class OpenOcdServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def QueryImage(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GdbTunnel(self, request_iterator, context):
+        """connection to the gdb port of the device's openocd, ends when either side closes it
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_OpenOcdServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -84,17 +118,22 @@ def add_OpenOcdServicer_to_server(servicer, server):
             ),
             'ResetDevice': grpc.unary_stream_rpc_method_handler(
                     servicer.ResetDevice,
-                    request_deserializer=openocd__pb2.void.FromString,
+                    request_deserializer=openocd__pb2.DeviceRequest.FromString,
                     response_serializer=openocd__pb2.LogStreamResponse.SerializeToString,
             ),
             'StartDebug': grpc.unary_unary_rpc_method_handler(
                     servicer.StartDebug,
-                    request_deserializer=openocd__pb2.void.FromString,
-                    response_serializer=openocd__pb2.void.SerializeToString,
+                    request_deserializer=openocd__pb2.DeviceRequest.FromString,
+                    response_serializer=openocd__pb2.DebugLease.SerializeToString,
+            ),
+            'RenewDebug': grpc.unary_unary_rpc_method_handler(
+                    servicer.RenewDebug,
+                    request_deserializer=openocd__pb2.DebugLease.FromString,
+                    response_serializer=openocd__pb2.DebugLease.SerializeToString,
             ),
             'StopDebug': grpc.unary_unary_rpc_method_handler(
                     servicer.StopDebug,
-                    request_deserializer=openocd__pb2.void.FromString,
+                    request_deserializer=openocd__pb2.DeviceRequest.FromString,
                     response_serializer=openocd__pb2.void.SerializeToString,
             ),
             'LogStreamCreate': grpc.unary_stream_rpc_method_handler(
@@ -102,6 +141,16 @@ def add_OpenOcdServicer_to_server(servicer, server):
                     request_deserializer=openocd__pb2.LogStreamRequest.FromString,
                     response_serializer=openocd__pb2.LogStreamResponse.SerializeToString,
             ),
+            'QueryImage': grpc.unary_unary_rpc_method_handler(
+                    servicer.QueryImage,
+                    request_deserializer=openocd__pb2.ImageRequest.FromString,
+                    response_serializer=openocd__pb2.ImageResponse.SerializeToString,
+            ),
+            'GdbTunnel': grpc.stream_stream_rpc_method_handler(
+                    servicer.GdbTunnel,
+                    request_deserializer=openocd__pb2.GdbData.FromString,
+                    response_serializer=openocd__pb2.GdbData.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'rpi.OpenOcd', rpc_method_handlers)
@@ -141,7 +190,7 @@ class OpenOcd(object):
             timeout=None,
             metadata=None):
         return grpc.experimental.unary_stream(request, target, '/rpi.OpenOcd/ResetDevice',
-            openocd__pb2.void.SerializeToString,
+            openocd__pb2.DeviceRequest.SerializeToString,
             openocd__pb2.LogStreamResponse.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -158,8 +207,25 @@ class OpenOcd(object):
             timeout=None,
             metadata=None):
         return grpc.experimental.unary_unary(request, target, '/rpi.OpenOcd/StartDebug',
-            openocd__pb2.void.SerializeToString,
-            openocd__pb2.void.FromString,
+            openocd__pb2.DeviceRequest.SerializeToString,
+            openocd__pb2.DebugLease.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def RenewDebug(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/rpi.OpenOcd/RenewDebug',
+            openocd__pb2.DebugLease.SerializeToString,
+            openocd__pb2.DebugLease.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
@@ -175,7 +241,7 @@ class OpenOcd(object):
             timeout=None,
             metadata=None):
         return grpc.experimental.unary_unary(request, target, '/rpi.OpenOcd/StopDebug',
-            openocd__pb2.void.SerializeToString,
+            openocd__pb2.DeviceRequest.SerializeToString,
             openocd__pb2.void.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -196,3 +262,37 @@ class OpenOcd(object):
             openocd__pb2.LogStreamResponse.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def QueryImage(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/rpi.OpenOcd/QueryImage',
+            openocd__pb2.ImageRequest.SerializeToString,
+            openocd__pb2.ImageResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def GdbTunnel(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(request_iterator, target, '/rpi.OpenOcd/GdbTunnel',
+            openocd__pb2.GdbData.SerializeToString,
+            openocd__pb2.GdbData.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -7,9 +7,12 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 import os
-import psutil
+import socket
 import platform
 import subprocess
+from pathlib import Path
+import oocd_tool.process_registry as process_registry
+from oocd_tool.readiness import ReadinessException, StderrWatch, forward_stderr, wait_ready
 
 
 class ConfigException(Exception):
@@ -22,21 +25,44 @@ class ProcessException(Exception):
         self.message = message
 
 
+def _key(command):
+    # processes are registered by executable name
+    words = command.split()
+    return Path(words[0]).name if words else command
+
+
 class BackgroundProcess:
-    def __init__(self, command, args, visible):
+    def __init__(self, command, args, visible, ready=None):
+        """'ready' is a readiness.ReadyCheck used by wait_ready(), stderr is read if it has a pattern."""
         self.cmd = command
+        self.key = _key(command)
+        self._ready = ready
+        self._watch = None
         kwargs = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP} if 'Windows' in platform.platform() else {}
-        redir = None if visible else subprocess.DEVNULL
-        self._proc = subprocess.Popen(command + ' ' + args, stderr=redir, start_new_session=True, cwd=os.getcwd(),
-                                      shell=True, **kwargs)
+        watch = ready is not None and ready.pattern
+        redir = subprocess.PIPE if watch else None if visible else subprocess.DEVNULL
+        self._proc = process_registry.REGISTRY.spawn(self.key, command + ' ' + args, stderr=redir, cwd=os.getcwd(),
+                                                     shell=True, **kwargs)
+        if watch:
+            self._watch = StderrWatch(self._proc.stderr, ready.pattern, forward_stderr if visible else None)
+
+    def wait_ready(self):
+        try:
+            wait_ready(self._proc, self._ready, self._watch)
+        except ReadinessException as e:
+            if e.returncode is None:
+                self.terminate()
+            raise ProcessException(e.message)
 
     def wait(self):
         self._proc.communicate()
+        process_registry.REGISTRY.unregister(self.key, self._proc.pid)
         if self._proc.returncode != 0:
             raise ProcessException('Error: {} returncode: {}'.format(self.cmd, self._proc.returncode))
 
     def terminate(self):
-        self._proc.terminate()
+        if not process_registry.REGISTRY.terminate(self.key, self._proc) and self._proc.poll() is None:
+            self._proc.terminate()
         if self._proc.returncode is not None and self._proc.returncode > 1:
             raise ProcessException('Error: {} returncode: {}'.format(self.cmd, self._proc.returncode))
 
@@ -56,13 +82,26 @@ class BlockingProcess:
 
 
 def is_process_running(name):
-    for proc in psutil.process_iter(['pid', 'name']):
-        try:
-            if proc.name() == name:
-                return True, proc.pid
-        except (psutil.NoSuchProcess, psutil.AccessDenied):
-            pass
-    return False, 0
+    """Returns (running, pid) of a process started by oocd-tool."""
+    entry = process_registry.REGISTRY.lookup(_key(name))
+    if entry is None:
+        return False, 0
+    return True, entry[0]
+
+
+def port_in_use(ports):
+    """Returns the first of 'ports' some process listens on, 0 if there is none. Tells of
+    processes not started by oocd-tool, binding connects to nothing (gdb would halt the target)."""
+    for port in ports:
+        with socket.socket() as sock:
+            if os.name != 'nt':
+                # not blocked by connections in TIME_WAIT, only by a listener
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(('localhost', port))
+            except OSError:
+                return port
+    return 0
 
 
 def terminate(proc):
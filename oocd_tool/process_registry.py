@@ -0,0 +1,214 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# PID files of the processes started by oocd-tool and oocd-rpcd. Only processes found here
+# are looked up or terminated, other processes with the same name are never touched.
+#
+import os
+import signal
+import asyncio
+import logging
+import contextlib
+import subprocess
+from time import monotonic, sleep
+from pathlib import Path
+
+_LOGGER = logging.getLogger(__name__)
+
+# seconds between SIGTERM and SIGKILL
+TERMINATE_TIMEOUT = 5.0
+_SIGKILL = getattr(signal, 'SIGKILL', signal.SIGTERM)
+_WINDOWS = os.name == 'nt'
+
+
+def _start_time(pid):
+    """Returns the start time of a process in clock ticks since boot, None if unknown."""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the command name in parentheses may contain spaces
+    return int(stat[stat.rfind(b')') + 2:].split()[19])
+
+
+def _stat(pid):
+    """Returns (state, pgid) of a process from /proc, None if unknown."""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            fields = f.read().rsplit(b')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return fields[0], int(fields[2])
+
+
+def _group_running(pgid):
+    """False if all members of the process group are zombies. Orphaned members are reaped
+    by init, which may be slow or, in a container, not happen at all. Scans /proc, only used
+    while terminating a group whose leader has exited."""
+    try:
+        pids = [int(name) for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return True
+    return any(stat is not None and stat[1] == pgid and stat[0] != b'Z' for stat in map(_stat, pids))
+
+
+def _leader_exited(pid, proc):
+    if proc is not None:
+        # reap our child, a zombie still counts as alive
+        return proc.poll() is not None
+    stat = _stat(pid)
+    return stat is None or stat[0] == b'Z'
+
+
+def _alive(pid, pgid):
+    if _WINDOWS:
+        import psutil
+        return psutil.pid_exists(pid)
+    try:
+        # a process group lives on as long as any member, e.g. openocd started by a shell
+        if pgid:
+            os.killpg(pgid, 0)
+        else:
+            os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _signal(pid, pgid, signum):
+    with contextlib.suppress(ProcessLookupError):
+        if pgid and not _WINDOWS:
+            os.killpg(pgid, signum)
+        else:
+            os.kill(pid, signum)
+
+
+class ProcessRegistry:
+    """PID files in 'directory', one per key, with the pid, process group and start time of the
+    process. A PID file whose process is gone, or whose pid was reused, is stale and removed."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def _file(self, key):
+        return self.directory / f"{key.replace(os.sep, '_')}.pid"
+
+    def spawn(self, key, cmd, **kwargs):
+        """Starts 'cmd' (subprocess.Popen arguments) in a new session and registers it."""
+        if not _WINDOWS:
+            kwargs['start_new_session'] = True
+        proc = subprocess.Popen(cmd, **kwargs)
+        # the leader of the new session, its group outlives it if it exits at once
+        self.register(key, proc.pid, proc.pid)
+        return proc
+
+    async def spawn_async(self, key, cmd, **kwargs):
+        """spawn() for asyncio, 'cmd' is a shell command (asyncio.create_subprocess_shell arguments).
+        The process is terminated if the caller is cancelled while it starts."""
+        if not _WINDOWS:
+            kwargs['start_new_session'] = True
+        spawn = asyncio.ensure_future(asyncio.create_subprocess_shell(cmd, **kwargs))
+        try:
+            proc = await asyncio.shield(spawn)
+        except asyncio.CancelledError:
+            # a cancelled create_subprocess_shell() may wait forever for the process it killed
+            proc = await spawn
+            self.register(key, proc.pid, proc.pid)
+            await self.terminate_async(key)
+            await proc.wait()
+            raise
+        self.register(key, proc.pid, proc.pid)
+        return proc
+
+    def register(self, key, pid, pgid=None):
+        """Writes the PID file of 'key', 'pgid' is looked up if not given."""
+        if _WINDOWS:
+            pgid = 0
+        elif pgid is None:
+            pgid = os.getpgid(pid)
+        start = _start_time(pid)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._file(key).write_text(f'{pid} {pgid} {start if start is not None else -1}\n')
+
+    def unregister(self, key, pid=None):
+        """Removes the PID file of 'key', only if it belongs to 'pid' if given."""
+        entry = self._read(key)
+        if entry is not None and (pid is None or entry[0] == pid):
+            with contextlib.suppress(FileNotFoundError):
+                self._file(key).unlink()
+
+    def _read(self, key):
+        try:
+            pid, pgid, start = (int(field) for field in self._file(key).read_text().split())
+        except (OSError, ValueError):
+            return None
+        return pid, pgid, start
+
+    def lookup(self, key):
+        """Returns (pid, pgid) of the live process registered as 'key', None if there is none."""
+        entry = self._read(key)
+        if entry is None:
+            return None
+        pid, pgid, start = entry
+        current = _start_time(pid)
+        reused = start != -1 and current is not None and current != start
+        if reused or not _alive(pid, pgid):
+            _LOGGER.debug(f"Removing stale PID file of '{key}' (pid {pid}).")
+            self.unregister(key, pid)
+            return None
+        return pid, pgid
+
+    def keys(self, prefix=''):
+        return [file.stem for file in self.directory.glob(f'{prefix}*.pid')]
+
+    def terminate(self, key, proc=None, timeout=TERMINATE_TIMEOUT):
+        """Terminates the process group registered as 'key': SIGTERM, then SIGKILL if it is still
+        running after 'timeout' seconds. 'proc' is the Popen object if the process is our child,
+        it is reaped. Returns False if no process was registered."""
+        entry = self.lookup(key)
+        if entry is None:
+            if proc is not None:
+                proc.poll()
+            return False
+        pid, pgid = entry
+        _signal(pid, pgid, signal.SIGTERM)
+        if not self._wait(pid, pgid, proc, timeout):
+            _LOGGER.warning(f"'{key}' (pid {pid}) did not exit within {timeout}s, killing it.")
+            _signal(pid, pgid, _SIGKILL)
+            self._wait(pid, pgid, proc, timeout)
+        self.unregister(key, pid)
+        return True
+
+    async def terminate_async(self, key, timeout=TERMINATE_TIMEOUT):
+        """terminate() for processes started by spawn_async(), asyncio reaps them itself."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.terminate, key, None, timeout)
+
+    def terminate_all(self, prefix='', timeout=TERMINATE_TIMEOUT):
+        """Terminates all registered processes with keys starting with 'prefix'."""
+        for key in self.keys(prefix):
+            if self.terminate(key, timeout=timeout):
+                _LOGGER.info(f"Terminated '{key}' left behind by a previous instance.")
+
+    @staticmethod
+    def _wait(pid, pgid, proc, timeout):
+        deadline = monotonic() + timeout
+        while True:
+            exited = _leader_exited(pid, proc)
+            if not _alive(pid, pgid):
+                return True
+            if pgid and exited and not _group_running(pgid):
+                return True
+            if monotonic() >= deadline:
+                return False
+            sleep(0.02)
+
+
+REGISTRY = ProcessRegistry(Path(Path.home(), '.oocd-tool', 'run'))
@@ -0,0 +1,155 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Detects when a spawned openocd accepts connections: from the "Listening on port" lines on
+# its stderr and/or by connecting to its ports.
+#
+import re
+import sys
+import socket
+import asyncio
+import threading
+from collections import namedtuple
+from time import monotonic, sleep
+
+LISTENING = r'Listening on port \d+ for gdb connections'
+READY_TIMEOUT = 10.0
+_POLL_INTERVAL = 0.02
+
+
+class ReadinessException(Exception):
+    def __init__(self, message, returncode=None):
+        self.message = message
+        self.returncode = returncode
+
+
+class ReadyCheck(namedtuple('ReadyCheck', 'pattern ports timeout')):
+    """When openocd is ready: 'pattern' matched a line on its stderr (regular expression, empty
+    to not watch stderr) or all 'ports' on localhost accept connections."""
+
+    @classmethod
+    def from_config(cls, config):
+        # ports may refer to other keys, e.g. {tcl_port}
+        ports = config.get('ready_ports', '').format(**config)
+        return cls(config.get('ready_pattern', LISTENING), [int(port) for port in ports.split()],
+                   float(config.get('ready_timeout', str(READY_TIMEOUT))))
+
+
+def forward_stderr(line):
+    sys.stderr.write(line)
+    sys.stderr.flush()
+
+
+class StderrWatch:
+    """Reads the stderr pipe of a process in a thread until it is closed, passes each line to
+    'output' and sets 'matched' at the first line matching 'pattern'."""
+
+    def __init__(self, stream, pattern, output=None):
+        self.matched = threading.Event()
+        self._stream = stream
+        self._pattern = re.compile(pattern)
+        self._output = output
+        threading.Thread(target=self._run, name='stderr-watch', daemon=True).start()
+
+    def _run(self):
+        with self._stream:
+            for data in iter(self._stream.readline, b''):
+                line = data.decode(errors='replace')
+                if self._output is not None:
+                    self._output(line)
+                if not self.matched.is_set() and self._pattern.search(line):
+                    self.matched.set()
+
+
+def _accepts(port):
+    try:
+        socket.create_connection(('localhost', port), timeout=0.2).close()
+        return True
+    except OSError:
+        return False
+
+
+def wait_ready(proc, check, watch=None):
+    """Returns as soon as 'proc' is ready according to 'check', 'watch' is the StderrWatch of the
+    process if its stderr is read. Raises ReadinessException if the process exits first or is not
+    ready within check.timeout. Returns at once if there is nothing to wait for."""
+    deadline = monotonic() + check.timeout
+    pending = list(check.ports)
+    while True:
+        ret = proc.poll()
+        if ret is not None:
+            raise ReadinessException(f'Error: openocd prematurely exited with code: {ret}', ret)
+        if watch is not None and watch.matched.is_set():
+            return
+        if check.ports:
+            pending = [port for port in pending if not _accepts(port)]
+            if not pending:
+                return
+        elif watch is None:
+            return
+        if monotonic() > deadline:
+            raise ReadinessException(f'Error: openocd not ready within {check.timeout}s')
+        if watch is not None:
+            watch.matched.wait(_POLL_INTERVAL)
+        else:
+            sleep(_POLL_INTERVAL)
+
+
+class AsyncStderrWatch:
+    """StderrWatch for the stderr StreamReader of an asyncio subprocess, read in a task."""
+
+    def __init__(self, stream, pattern, output=None):
+        self.matched = asyncio.Event()
+        self._stream = stream
+        self._pattern = re.compile(pattern)
+        self._output = output
+        self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        async for data in self._stream:
+            line = data.decode(errors='replace')
+            if self._output is not None:
+                self._output(line)
+            if not self.matched.is_set() and self._pattern.search(line):
+                self.matched.set()
+
+
+async def _accepts_async(port):
+    try:
+        _reader, writer = await asyncio.wait_for(asyncio.open_connection('localhost', port), 0.2)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+
+async def wait_ready_async(proc, check, watch=None):
+    """wait_ready() for an asyncio subprocess, 'watch' is its AsyncStderrWatch."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + check.timeout
+    pending = list(check.ports)
+    while True:
+        ret = proc.returncode
+        if ret is not None:
+            raise ReadinessException(f'Error: openocd prematurely exited with code: {ret}', ret)
+        if watch is not None and watch.matched.is_set():
+            return
+        if check.ports:
+            pending = [port for port in pending if not await _accepts_async(port)]
+            if not pending:
+                return
+        elif watch is None:
+            return
+        if loop.time() > deadline:
+            raise ReadinessException(f'Error: openocd not ready within {check.timeout}s')
+        if watch is not None:
+            try:
+                await asyncio.wait_for(watch.matched.wait(), _POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            await asyncio.sleep(_POLL_INTERVAL)
@@ -9,9 +9,24 @@ import sys
 import grpc
 import signal
 import contextlib
+from time import monotonic, sleep
 import oocd_tool.openocd_pb2 as openocd_pb2
 import oocd_tool.openocd_pb2_grpc as openocd_pb2_grpc
 import oocd_tool._credentials as _credentials
+from oocd_tool.image_cache import file_digest
+from oocd_tool.compression import choose_encoding, compressor
+
+_CHUNK_MIN = 16384
+_CHUNK_MAX = 262144
+# chunk size is adapted to keep the time per message around this value
+_CHUNK_TARGET_TIME = 0.05
+# log streams reconnect with exponential backoff between these delays
+_RECONNECT_DELAY_MIN = 0.5
+_RECONNECT_DELAY_MAX = 5.0
+# detects dead connections on idle log streams
+_CHANNEL_OPTIONS = [('grpc.keepalive_time_ms', 10000), ('grpc.keepalive_timeout_ms', 5000)]
+_RENEW_TIMEOUT = 5.0
+_GDB_CHUNK = 65536
 
 
 def _setup_cancel_request(generator):
@@ -33,76 +48,309 @@ class AuthGateway(grpc.AuthMetadataPlugin):
 
 @contextlib.contextmanager
 def insecure_channel(addr, _unused_signatur):
-    yield grpc.insecure_channel(addr)
+    yield grpc.insecure_channel(addr, options=_CHANNEL_OPTIONS)
 
 
-@contextlib.contextmanager
-def secure_channel(addr, auth):
+def create_secure_channel(addr, auth, root_certificate=None, options=_CHANNEL_OPTIONS):
     call_credentials = grpc.metadata_call_credentials(
         AuthGateway(auth), name='auth gateway')
     channel_credential = grpc.ssl_channel_credentials(
-        _credentials.ROOT_CERTIFICATE)
+        root_certificate or _credentials.ROOT_CERTIFICATE)
     composite_credentials = grpc.composite_channel_credentials(
         channel_credential, call_credentials)
 
-    channel = grpc.secure_channel(addr, composite_credentials)
-    yield channel
+    return grpc.secure_channel(addr, composite_credentials, options=options)
+
+
+@contextlib.contextmanager
+def secure_channel(addr, auth):
+    yield create_secure_channel(addr, auth)
 
 
 def load_certificates(config):
     _credentials.load_certificates(config)
 
 
+def client_id():
+    """Identifies the requests of this user to the server, see ProgramRequest.client."""
+    import getpass
+    import socket
+    try:
+        user = getpass.getuser()
+    except (KeyError, OSError):
+        user = ''
+    return f'{user}@{socket.gethostname()}'
+
+
+def queue_status(position, eta_ms):
+    if not eta_ms:
+        return f'waiting for device: position {position}\n'
+    return f'waiting for device: position {position}, about {max(round(eta_ms / 1000), 1)}s\n'
+
+
+def _print_status(text):
+    sys.stderr.write(text)
+    sys.stderr.flush()
+
+
+def _gap_marker(lost, suppressed=0):
+    if not suppressed:
+        return f'--- {lost} bytes of log lost ---\n'
+    if not lost:
+        return f'--- {suppressed} lines suppressed by rate limit ---\n'
+    return f'--- {lost} bytes of log lost, {suppressed} lines suppressed by rate limit ---\n'
+
+
+class UploadStats:
+    def __init__(self, encoding):
+        self.encoding = encoding or 'none'
+        self.size = 0
+        self.sent = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        rate = self.size / self.elapsed / 1e6 if self.elapsed > 0 else 0.0
+        return (f'upload: {self.size} bytes ({self.sent} sent, compression: {self.encoding}) '
+                f'in {self.elapsed:.2f}s, {rate:.2f} MB/s')
+
+
+def upload_requests(file, digest, device, encoding='', chunk_max=_CHUNK_MAX, stats=None, **fields):
+    """Yields the ProgramRequests of a file, with the extra 'fields' e.g. priority. The chunk size grows
+    towards 'chunk_max' while messages are consumed faster than _CHUNK_TARGET_TIME, and shrinks when slower."""
+    comp = compressor(encoding)
+    chunk = min(_CHUNK_MIN, chunk_max)
+    start = monotonic()
+    with open(file, 'rb') as f:
+        while True:
+            data = f.read(chunk)
+            payload = comp.compress(data) if comp is not None and data else data
+            if not data and comp is not None:
+                payload = comp.flush()
+            if stats is not None:
+                stats.size += len(data)
+                stats.sent += len(payload)
+            if payload:
+                sent = monotonic()
+                yield openocd_pb2.ProgramRequest(data=payload, digest=digest, device=device, encoding=encoding,
+                                                 **fields)
+                elapsed = monotonic() - sent
+                if elapsed < _CHUNK_TARGET_TIME:
+                    chunk = min(chunk * 2, chunk_max)
+                elif elapsed > 4 * _CHUNK_TARGET_TIME:
+                    chunk = max(chunk // 2, _CHUNK_MIN)
+            if not data:
+                break
+    if stats is not None:
+        stats.elapsed = monotonic() - start
+
+
 class ClientChannel:
-    def __init__(self, host, channel, auth):
+    def __init__(self, host, channel, auth, device='', chunk_max=_CHUNK_MAX, verbose=False,
+                 on_call=_setup_cancel_request, priority='interactive', deadline=None, status=_print_status):
         self._host = host
         self._channel_type = channel
         self._auth_key = auth
+        self._device = device
+        self._chunk_max = chunk_max
+        self._verbose = verbose
+        # called with every streaming call started, cancels it on SIGINT by default
+        self._on_call = on_call
+        # queueing of program and reset on the server, 'deadline' in seconds for the whole operation
+        self._job = {'priority': openocd_pb2.Priority.Value(priority.upper()), 'client': client_id()}
+        self._deadline = deadline
+        # called with the queue position while waiting for the device
+        self._status = status
+        # set while connected(), shared by all calls
+        self._channel = None
+        # statistics of the last upload, None if the image was cached
+        self.upload_stats = None
 
     def is_secure(self):
         return self._channel_type == secure_channel
 
-    def log_stream_create(self, file):
+    @contextlib.contextmanager
+    def connected(self):
+        """Makes the calls in the body share one connection, e.g. a debug session and its gdb tunnel."""
+        with self._channel_type(self._host, self._auth_key) as channel:
+            self._channel = channel
+            try:
+                yield
+            finally:
+                self._channel = None
+
+    @contextlib.contextmanager
+    def _connect(self):
+        if self._channel is not None:
+            yield self._channel
+            return
         with self._channel_type(self._host, self._auth_key) as channel:
+            yield channel
+
+    def _resumable_log_stream(self, request):
+        """Yields the LogStreamResponses of 'request'. Reconnects if the connection is lost
+        and resumes after the last received offset."""
+        delay = _RECONNECT_DELAY_MIN
+        reconnect = False
+        with self._connect() as channel:
             stub = openocd_pb2_grpc.OpenOcdStub(channel)
+            while True:
+                try:
+                    # wait for the connection to come back instead of failing fast
+                    result_generator = stub.LogStreamCreate(request, wait_for_ready=reconnect)
+                    self._on_call(result_generator)
 
-            result_generator = stub.LogStreamCreate(openocd_pb2.LogStreamRequest(filename=file))
-            _setup_cancel_request(result_generator)
+                    for result in result_generator:
+                        delay = _RECONNECT_DELAY_MIN
+                        if result.offset:
+                            request.resume_from = result.offset
+                        yield result
+                    return
+                except grpc.RpcError as e:
+                    if e.code() not in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.RESOURCE_EXHAUSTED):
+                        raise
+                    sys.stderr.write(f'log stream: {e.details()}, reconnecting in {delay:.1f}s\n')
+                    sleep(delay)
+                    delay = min(delay * 2, _RECONNECT_DELAY_MAX)
+                    reconnect = True
+
+    def log_stream_create(self, file, **filters):
+        """Yields the lines of a log file. 'filters' are applied by the server, see LogStreamRequest."""
+        for result in self._resumable_log_stream(openocd_pb2.LogStreamRequest(filename=file, **filters)):
+            if result.lost or result.suppressed:
+                yield _gap_marker(result.lost, result.suppressed).strip()
+            yield result.data.strip()
+
+    def log_stream_blocks(self, file, interval_ms, batch_size=65536, **filters):
+        """Yields the log as blocks of lines (bytes), coalesced by the server for up to 'interval_ms'."""
+        request = openocd_pb2.LogStreamRequest(filename=file, batch_interval_ms=interval_ms, batch_size=batch_size,
+                                               **filters)
+        for result in self._resumable_log_stream(request):
+            if result.lost or result.suppressed:
+                yield _gap_marker(result.lost, result.suppressed).encode()
+            # servers without batching send single lines
+            yield result.lines if result.lines else result.data.encode()
+
+    def log_stream_itm(self, file, ports, ts_freq, interval_ms, **filters):
+        """Yields (port, timestamp, lines) of a raw ITM trace file decoded by the server."""
+        with self._connect() as channel:
+            stub = openocd_pb2_grpc.OpenOcdStub(channel)
+
+            request = openocd_pb2.LogStreamRequest(filename=file, batch_interval_ms=interval_ms, batch_size=65536,
+                                                   itm=True, ports=ports, ts_freq=ts_freq, **filters)
+            result_generator = stub.LogStreamCreate(request)
+            self._on_call(result_generator)
 
             for result in result_generator:
-                yield result.data.strip()
+                if result.suppressed:
+                    yield result.port, result.timestamp, _gap_marker(0, result.suppressed).encode()
+                yield result.port, result.timestamp, result.lines if result.lines else result.data.encode()
 
     def program_device(self, file):
-        with self._channel_type(self._host, self._auth_key) as channel:
+        with self._connect() as channel:
             stub = openocd_pb2_grpc.OpenOcdStub(channel)
+            digest = file_digest(file)
 
-            def file_reader(filename):
-                with open(filename, 'rb') as f:
-                    while chunk := f.read(2048):
-                        request = openocd_pb2.ProgramRequest(data=chunk)
-                        yield request
+            def program(requests):
+                result_generator = stub.ProgramDevice(requests, timeout=self._deadline)
+                self._on_call(result_generator)
+                yield from self._output(result_generator)
 
-            result_generator = stub.ProgramDevice(file_reader(file))
-            _setup_cancel_request(result_generator)
+            self.upload_stats = None
+            cached, encodings = self._query_image(stub, digest)
+            if cached:
+                try:
+                    request = openocd_pb2.ProgramRequest(digest=digest, device=self._device, **self._job)
+                    yield from program(iter([request]))
+                    return
+                except grpc.RpcError as e:
+                    # evicted since the query, fall back to a full upload
+                    if e.code() != grpc.StatusCode.FAILED_PRECONDITION:
+                        raise
+            stats = self.upload_stats = UploadStats(choose_encoding(encodings))
+            yield from program(upload_requests(file, digest, self._device, choose_encoding(encodings),
+                                               self._chunk_max, stats, **self._job))
+            if self._verbose:
+                sys.stderr.write(f'{stats}\n')
 
-            for result in result_generator:
-                yield result.data.strip()
+    def _output(self, result_generator):
+        """Yields the output lines of program and reset, the queue position goes to 'status'."""
+        for result in result_generator:
+            if result.queue_position:
+                self._status(queue_status(result.queue_position, result.queue_eta_ms))
+                continue
+            yield result.data.strip()
+
+    @staticmethod
+    def _query_image(stub, digest):
+        """Returns (cached, encodings) for an image digest."""
+        try:
+            response = stub.QueryImage(openocd_pb2.ImageRequest(digest=digest))
+            return response.cached, list(response.encodings)
+        except grpc.RpcError as e:
+            # server without image cache support
+            if e.code() != grpc.StatusCode.UNIMPLEMENTED:
+                raise
+            return False, []
 
     def reset_device(self):
-        with self._channel_type(self._host, self._auth_key) as channel:
+        with self._connect() as channel:
             stub = openocd_pb2_grpc.OpenOcdStub(channel)
-            result_generator = stub.ResetDevice(openocd_pb2.void())
-            _setup_cancel_request(result_generator)
+            result_generator = stub.ResetDevice(openocd_pb2.DeviceRequest(device=self._device, **self._job),
+                                                timeout=self._deadline)
+            self._on_call(result_generator)
+            yield from self._output(result_generator)
 
-            for result in result_generator:
-                yield result.data.strip()
+    def start_debug(self):
+        """Returns (lease_id, ttl) of the debug session, see lease.debug_session()."""
+        with self._connect() as channel:
+            lease = openocd_pb2_grpc.OpenOcdStub(channel).StartDebug(
+                openocd_pb2.DeviceRequest(device=self._device, lease=True, **self._job))
+            return lease.lease_id, lease.ttl_ms / 1000
+
+    def renew_debug(self, lease_id):
+        with self._connect() as channel:
+            try:
+                lease = openocd_pb2_grpc.OpenOcdStub(channel).RenewDebug(
+                    openocd_pb2.DebugLease(device=self._device, lease_id=lease_id), timeout=_RENEW_TIMEOUT)
+                return lease.ttl_ms / 1000
+            except grpc.RpcError as e:
+                if e.code() == grpc.StatusCode.NOT_FOUND:
+                    return 0
+                # retried at the next renewal
+                return None
+
+    def stop_debug(self, lease_id=''):
+        with self._connect() as channel:
+            openocd_pb2_grpc.OpenOcdStub(channel).StopDebug(
+                openocd_pb2.DeviceRequest(device=self._device, lease_id=lease_id, **self._job))
 
-    @contextlib.contextmanager
     def debug_device(self):
-        with self._channel_type(self._host, self._auth_key) as channel:
-            stub = openocd_pb2_grpc.OpenOcdStub(channel)
-        try:
-            stub.StartDebug(openocd_pb2.void())
-            yield
-        finally:
-            stub.StopDebug(openocd_pb2.void())
+        from oocd_tool.lease import debug_session
+        return debug_session(self)
+
+    def gdb_tunnel(self, sock):
+        """Forwards the gdb connection 'sock' to the gdb port of the device until either side closes it."""
+        def requests():
+            yield openocd_pb2.GdbData(device=self._device)
+            while True:
+                # what gdb sent since the last read goes in one message
+                try:
+                    data = sock.recv(_GDB_CHUNK)
+                except OSError:
+                    return
+                if not data:
+                    return
+                yield openocd_pb2.GdbData(data=data)
+
+        with self._connect() as channel:
+            responses = openocd_pb2_grpc.OpenOcdStub(channel).GdbTunnel(requests())
+            try:
+                for response in responses:
+                    sock.sendall(response.data)
+            except grpc.RpcError as e:
+                if e.code() != grpc.StatusCode.CANCELLED:
+                    sys.stderr.write(f'gdb tunnel: {e.details()}\n')
+            except OSError:
+                pass  # gdb is gone
+            finally:
+                responses.cancel()
@@ -7,134 +7,136 @@
 #
 import sys
 import grpc
-import signal
-import contextlib
+import asyncio
 import oocd_tool.openocd_pb2 as openocd_pb2
 import oocd_tool.openocd_pb2_grpc as openocd_pb2_grpc
 import oocd_tool._credentials as _credentials
-import asyncio
-
-def _setup_cancel_request(generator):
-    def cancel_request(unused_signum, unused_frame):
-        generator.cancel()
-        sys.exit(0)
+from oocd_tool.image_cache import file_digest
+from oocd_tool.compression import choose_encoding
+from oocd_tool.rpc_client import AuthGateway, upload_requests, client_id, queue_status, _CHUNK_MAX
 
-    signal.signal(signal.SIGINT, cancel_request)
 
-class AuthGateway(grpc.AuthMetadataPlugin):
-    def __init__(self, auth_key):
-        self.auth_key = auth_key
+def insecure_channel(addr, _unused_signatur):
+    return grpc.aio.insecure_channel(addr)
 
-    def __call__(self, context, callback):
-        signature = context.method_name[::-1]
-        callback(((self.auth_key, signature),), None)
 
-@contextlib.contextmanager
-def insecure_channel(addr, unused_signatur):
-    yield grpc.aio.insecure_channel(addr)
-
-@contextlib.contextmanager
 def secure_channel(addr, auth):
-    call_credentials = grpc.aio.metadata_call_credentials(
+    call_credentials = grpc.metadata_call_credentials(
         AuthGateway(auth), name='auth gateway')
-    channel_credential = grpc.aio.ssl_channel_credentials(
+    channel_credential = grpc.ssl_channel_credentials(
         _credentials.ROOT_CERTIFICATE)
-    composite_credentials = grpc.aio.composite_channel_credentials(
+    composite_credentials = grpc.composite_channel_credentials(
         channel_credential, call_credentials)
 
-    channel = grpc.aio.secure_channel(addr, composite_credentials)
-    yield channel
+    return grpc.aio.secure_channel(addr, composite_credentials)
+
 
 def load_certificates(config):
     _credentials.load_certificates(config)
 
+
 class ClientChannel:
-    def __init__(self, host, channel, auth):
+    def __init__(self, host, channel, auth, device='', chunk_max=_CHUNK_MAX, priority='interactive', deadline=None):
         self._host = host
         self._channel_type = channel
         self._auth_key = auth
+        self._device = device
+        self._chunk_max = chunk_max
+        self._job = {'priority': openocd_pb2.Priority.Value(priority.upper()), 'client': client_id()}
+        self._deadline = deadline
 
     def is_secure(self):
         return self._channel_type == secure_channel
 
-    async def log_stream_create(self, file, proc):
+    async def log_stream_create(self, file):
         async with self._channel_type(self._host, self._auth_key) as channel:
-            stub = openocd_pb2_grpc.aio.OpenOcdStub(channel)
-
-            result_generator = await stub.LogStreamCreate(openocd_pb2.LogStreamRequest(filename=file))
-            _setup_cancel_request(result_generator)
-
-            async for result in result_generator:
-                proc(result.data.strip())
-
-    def program_device(self, file):
-        with self._channel_type(self._host, self._auth_key) as channel:
-            stub = openocd_pb2_grpc.aio.OpenOcdStub(channel)
-
-            def file_reader(filename):
-                with open(filename, 'rb') as file:
-                    while chunk := file.read(2048):
-                        request = openocd_pb2.ProgramRequest(data=chunk)
-                        yield request
-
-            result_generator = stub.ProgramDevice(file_reader(file))
-            _setup_cancel_request(result_generator)
+            stub = openocd_pb2_grpc.OpenOcdStub(channel)
 
-            for result in result_generator:
-               yield result.data.strip()
+            async for result in stub.LogStreamCreate(openocd_pb2.LogStreamRequest(filename=file)):
+                yield result.data.strip()
 
-    def reset_device(self):
-        with self._channel_type(self._host, self._auth_key) as channel:
-            stub = openocd_pb2_grpc.aio.OpenOcdStub(channel)
-            result_generator = stub.ResetDevice(openocd_pb2.void())
-            _setup_cancel_request(result_generator)
-
-            for result in result_generator:
-               yield result.data.strip()
-
-
-    @contextlib.contextmanager
-    def debug_device(self):
-        with self._channel_type(self._host, self._auth_key) as channel:
-            stub = openocd_pb2_grpc.aio.OpenOcdStub(channel)
+    async def program_device(self, file, digest=None):
+        async with self._channel_type(self._host, self._auth_key) as channel:
+            stub = openocd_pb2_grpc.OpenOcdStub(channel)
+            if digest is None:
+                digest = file_digest(file)
+
+            cached, encodings = await self._query_image(stub, digest)
+            if cached:
+                try:
+                    requests = iter([openocd_pb2.ProgramRequest(digest=digest, device=self._device, **self._job)])
+                    async for line in self._output(stub.ProgramDevice(requests, timeout=self._deadline)):
+                        yield line
+                    return
+                except grpc.aio.AioRpcError as e:
+                    # evicted since the query, fall back to a full upload
+                    if e.code() != grpc.StatusCode.FAILED_PRECONDITION:
+                        raise
+
+            requests = upload_requests(file, digest, self._device, choose_encoding(encodings), self._chunk_max,
+                                       **self._job)
+            async for line in self._output(stub.ProgramDevice(requests, timeout=self._deadline)):
+                yield line
+
+    @staticmethod
+    async def _output(result_generator):
+        # the queue position is output like a line
+        async for result in result_generator:
+            if result.queue_position:
+                yield queue_status(result.queue_position, result.queue_eta_ms).strip()
+            else:
+                yield result.data.strip()
+
+    @staticmethod
+    async def _query_image(stub, digest):
+        """Returns (cached, encodings) for an image digest."""
         try:
-            stub.StartDebug(openocd_pb2.void())
-            yield
-        finally:
-            stub.StopDebug(openocd_pb2.void())
-
-
-
-def get_credentials(shared_secret):
-    call_credentials = grpc.metadata_call_credentials(AuthGateway(shared_secret), name='auth gateway')
-    channel_credential = grpc.ssl_channel_credentials(_credentials.ROOT_CERTIFICATE)
-    return grpc.composite_channel_credentials(channel_credential, call_credentials)
+            response = await stub.QueryImage(openocd_pb2.ImageRequest(digest=digest))
+            return response.cached, list(response.encodings)
+        except grpc.aio.AioRpcError as e:
+            # server without image cache support
+            if e.code() != grpc.StatusCode.UNIMPLEMENTED:
+                raise
+            return False, []
+
+    async def reset_device(self):
+        async with self._channel_type(self._host, self._auth_key) as channel:
+            stub = openocd_pb2_grpc.OpenOcdStub(channel)
 
+            request = openocd_pb2.DeviceRequest(device=self._device, **self._job)
+            async for line in self._output(stub.ResetDevice(request, timeout=self._deadline)):
+                yield line
 
-async def test(file, proc):
-    async with grpc.aio.secure_channel("pi:50051", get_credentials("my-secret-key_blabla")) as channel:
-        stub = openocd_pb2_grpc.OpenOcdStub(channel)
 
-        result_generator = stub.LogStreamCreate(openocd_pb2.LogStreamRequest(filename=file))
-        _setup_cancel_request(result_generator)
+def _print_line(target, line):
+    sys.stdout.write(f'[{target}] {line}\n')
 
-        async for result in result_generator:
-            proc(result.data.strip())
 
+async def _run_target(target, channel, auth, cmd, file, digest, output, options):
+    # target syntax: host:port[/device]
+    host, _, device = target.partition('/')
+    rpc = ClientChannel(host, channel, auth, device, **options)
+    stream = rpc.program_device(file, digest) if cmd == 'program' else rpc.reset_device()
+    try:
+        async for line in stream:
+            output(target, line)
+    except grpc.aio.AioRpcError as e:
+        output(target, f'Error: {e.code().name}: {e.details()}')
+        return False
+    except OSError as e:
+        output(target, f'Error: {e}')
+        return False
+    return True
 
-class LogStream:
-    def __init__(self, file):
-        self.channel = grpc.aio.secure_channel("pi:50051", get_credentials("my-secret-key_blabla"))
-        stub = openocd_pb2_grpc.OpenOcdStub(self.channel)
-        self.result_generator = stub.LogStreamCreate(openocd_pb2.LogStreamRequest(filename=file))
 
-    async def _output_stream(self, callback):
-        async for result in self.result_generator:
-            callback(result.data)
-        self.channel.close()
+async def _run_fleet(targets, channel, auth, cmd, file, output, options):
+    digest = file_digest(file) if cmd == 'program' else None
+    return await asyncio.gather(*(_run_target(t, channel, auth, cmd, file, digest, output, options)
+                                  for t in targets))
 
-    def cancel(self):
-        self.result_generator.cancel()
 
-    def start_output(self, callback):
-        asyncio.create_task(self._output_stream(callback))
\ No newline at end of file
+def run_fleet(targets, channel, auth, cmd, file=None, output=_print_line, **options):
+    """Runs 'program' or 'reset' on all targets concurrently, 'options' are ClientChannel arguments
+    e.g. priority. Returns the list of failed targets."""
+    results = asyncio.run(_run_fleet(targets, channel, auth, cmd, file, output, options))
+    return [target for target, ok in zip(targets, results) if not ok]
@@ -6,12 +6,26 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 import os
-import signal
-import psutil
+import socket
+import asyncio
+import hashlib
+import secrets
 import subprocess
+import threading
 import logging
 import platform
-from time import sleep
+import contextlib
+import tempfile
+from time import sleep, monotonic
+from operator import attrgetter
+from oocd_tool.elf import ElfException, load_segments_from_file
+from oocd_tool.flash import sector_contents, changed_ranges, parse_sector_layout
+from oocd_tool.tail import FileTail
+from oocd_tool.itm import ItmDecoder
+from oocd_tool.job_queue import JobQueue, PRIORITY_INTERACTIVE
+from oocd_tool.readiness import ReadinessException, ReadyCheck, AsyncStderrWatch, forward_stderr, wait_ready_async
+import oocd_tool.metrics as metrics
+import oocd_tool.process_registry as process_registry
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -21,13 +35,28 @@ class ConfigException(Exception):
         self.message = message
 
 
-def openocd_cmd(cmd):
-    killall("openocd")
-    proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, universal_newlines=True, cwd=os.getcwd(), shell=True)
-    for ln in iter(proc.stderr.readline, ""):
-        yield ln
-    proc.stderr.close()
-    ret = proc.wait()
+class SessionException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+async def openocd_cmd(cmd, name='cmd', key=None):
+    key = key or f'rpcd.{name}'
+    start = monotonic()
+    proc = await process_registry.REGISTRY.spawn_async(key, cmd, stderr=asyncio.subprocess.PIPE, cwd=os.getcwd())
+    metrics.OPENOCD_SPAWN.observe(monotonic() - start, name)
+    try:
+        async for ln in proc.stderr:
+            yield ln.decode(errors='replace')
+        ret = await proc.wait()
+    except (asyncio.CancelledError, GeneratorExit):
+        # the RPC was cancelled or the generator closed early, the device must be freed at once
+        _LOGGER.info("Terminating '{}': RPC cancelled.".format(cmd))
+        await openocd_terminate(proc, key, name)
+        raise
+    process_registry.REGISTRY.unregister(key, proc.pid)
+    metrics.OPENOCD_RUN.observe(monotonic() - start, name)
+    metrics.OPENOCD_EXITS.inc(name, ret)
     if ret:
         _LOGGER.error("openocd_program failed: '{}', returncode: {}".format(cmd, ret))
         raise subprocess.CalledProcessError(ret, cmd)
@@ -40,61 +69,500 @@ def openocd_cmd(cmd):
 #        _LOGGER.error("openocd_cmd failed: '{}', returncode: {}".format(cmd, proc.returncode))
 #        raise subprocess.CalledProcessError(proc.returncode, cmd)
 
-def openocd_start_debug(cmd):
-    killall("openocd")
-    proc = subprocess.Popen(cmd, cwd=os.getcwd(), shell=True)
-    sleep(0.1)
-    ret = proc.poll()
-    if ret is not None:
-        _LOGGER.error("openocd_start_debug failed: '{}', returncode: {}".format(cmd, ret))
-        raise subprocess.CalledProcessError(ret, 'openocd_start_debug')
+async def openocd_start_debug(cmd, key='rpcd.debug', ready=None):
+    """Starts openocd for a debug session, returns when it is ready for gdb (see readiness.ReadyCheck)."""
+    ready = ready or ReadyCheck.from_config({})
+    start = monotonic()
+    stderr = asyncio.subprocess.PIPE if ready.pattern else None
+    proc = await process_registry.REGISTRY.spawn_async(key, cmd, stderr=stderr, cwd=os.getcwd())
+    # keeps forwarding stderr after openocd is ready
+    proc.stderr_watch = AsyncStderrWatch(proc.stderr, ready.pattern, forward_stderr) if ready.pattern else None
+    try:
+        await wait_ready_async(proc, ready, proc.stderr_watch)
+    except ReadinessException as e:
+        _LOGGER.error("openocd_start_debug failed: '{}': {}".format(cmd, e.message))
+        await openocd_terminate(proc, key)
+        raise
+    except asyncio.CancelledError:
+        await openocd_terminate(proc, key)
+        raise
+    metrics.OPENOCD_SPAWN.observe(monotonic() - start, 'debug')
+    return proc
+
+
+async def openocd_terminate(proc, key='rpcd.debug', name='debug'):
+    """Terminates the process group of 'proc' (SIGTERM, then SIGKILL) and waits for it."""
+    start = monotonic()
+    if not await process_registry.REGISTRY.terminate_async(key) and proc.returncode is None:
+        # PID file removed behind our back
+        proc.kill()
+    ret = await proc.wait()
+    process_registry.REGISTRY.unregister(key, proc.pid)
+    metrics.OPENOCD_EXIT.observe(monotonic() - start, name)
+    metrics.OPENOCD_EXITS.inc(name, ret)
+
+
+async def write_stream_to_file(filename, chunks):
+    """Returns the SHA-256 of the data. Stops at the next chunk if the upload is cancelled."""
+    h = hashlib.sha256()
+    with open(filename, "wb") as file:
+        async for data in chunks:
+            h.update(data)
+            file.write(data)
+    return h.hexdigest()
+
+
+async def in_thread(iterator, abort=None):
+    """Yields the items of a blocking iterator, each one is fetched in the default executor.
+    When cancelled, abort() is called to interrupt the fetch in progress, which is waited for:
+    the caller is done with whatever the iterator uses once the CancelledError arrives."""
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterator)
+    done = object()
+    while True:
+        fetch = loop.run_in_executor(None, next, iterator, done)
+        try:
+            item = await asyncio.shield(fetch)
+        except asyncio.CancelledError:
+            if abort is not None:
+                abort()
+            while not fetch.done():
+                with contextlib.suppress(asyncio.CancelledError):
+                    await asyncio.wait([fetch])
+            if not fetch.cancelled():
+                fetch.exception()
+            raise
+        if item is done:
+            return
+        yield item
+
+
+class OpenOcdSession:
+    """Long-lived openocd instance controlled through its TCL port."""
+    _TERMINATOR = b'\x1a'
+
+    def __init__(self, cmd, port=6666, timeout=10.0, key='rpcd.session'):
+        self.cmd = cmd
+        self.port = port
+        self.timeout = timeout
+        self.key = key
+        self._proc = None
+        self._sock = None
+        self._lock = threading.RLock()
+        self._watchdog = None
+        self._done = threading.Event()
+        # socket of the command in progress, and set while commands are aborted
+        self._busy = None
+        self._aborted = threading.Event()
+
+    def start(self):
+        with self._lock:
+            self._spawn()
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._supervise, daemon=True)
+            self._watchdog.start()
 
+    def stop(self):
+        self._done.set()
+        with self._lock:
+            self._close()
 
-def openocd_terminate():
-    killall("openocd")
+    def is_running(self):
+        return self._proc is not None and self._proc.poll() is None
 
+    def abort(self):
+        """Interrupts the command in progress from another thread, openocd is restarted to stop it.
+        Commands fail until resume() is called."""
+        self._aborted.set()
+        sock = self._busy
+        if sock is not None:
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+
+    def resume(self):
+        self._aborted.clear()
+
+    def is_aborted(self):
+        return self._aborted.is_set()
+
+    def run(self, cmd):
+        """Runs a TCL command in the session. Yields the captured output line by line."""
+        with self._lock:
+            if not self.is_running():
+                _LOGGER.warning("openocd session not running, restarting.")
+                self._spawn()
+            # abort() sets the flag before it looks at _busy
+            self._busy = self._sock
+            try:
+                if self._aborted.is_set():
+                    raise SessionException("Error: openocd command aborted: '{}'".format(cmd))
+                failed = self._eval('catch {{capture {{{}}}}} _oocd_result'.format(cmd)) != '0'
+                output = self._eval('set _oocd_result')
+            except OSError as e:
+                if self._aborted.is_set():
+                    _LOGGER.info("openocd command aborted, restarting session: '{}'".format(cmd))
+                else:
+                    _LOGGER.error("openocd session lost: {}".format(e))
+                self._spawn()
+                raise SessionException("Error: openocd session lost while running: '{}'".format(cmd))
+            finally:
+                self._busy = None
+        for ln in output.splitlines():
+            yield ln + '\n'
+        if failed:
+            _LOGGER.error("openocd session command failed: '{}'".format(cmd))
+            raise SessionException("Error: openocd command failed: '{}'".format(cmd))
+
+    def _eval(self, cmd):
+        self._sock.sendall(cmd.encode() + self._TERMINATOR)
+        data = b''
+        while not data.endswith(self._TERMINATOR):
+            chunk = self._sock.recv(4096)
+            if not chunk:
+                raise ConnectionResetError("openocd closed the TCL connection")
+            data += chunk
+        return data[:-1].decode(errors='replace')
+
+    def _spawn(self):
+        self._close()
+        _LOGGER.info("Starting openocd session: '{}'".format(self.cmd))
+        start = monotonic()
+        self._proc = process_registry.REGISTRY.spawn(self.key, self.cmd, stdout=subprocess.DEVNULL,
+                                                     stderr=subprocess.DEVNULL, cwd=os.getcwd(), shell=True)
+        deadline = monotonic() + self.timeout
+        while True:
+            try:
+                self._sock = socket.create_connection(('localhost', self.port), timeout=self.timeout)
+                # the timeout is for connecting only, flashing may take much longer. A dead
+                # openocd closes the connection.
+                self._sock.settimeout(None)
+                metrics.OPENOCD_SPAWN.observe(monotonic() - start, 'session')
+                return
+            except OSError:
+                ret = self._proc.poll()
+                if ret is not None:
+                    raise SessionException("Error: openocd session exited with code: {}".format(ret))
+                if monotonic() > deadline:
+                    self._close()
+                    raise SessionException("Error: openocd session not ready within {}s".format(self.timeout))
+                sleep(0.05)
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._proc is not None:
+            if self._proc.poll() is None:
+                start = monotonic()
+                if not process_registry.REGISTRY.terminate(self.key, self._proc, self.timeout):
+                    self._proc.kill()
+                self._proc.wait()
+                metrics.OPENOCD_EXIT.observe(monotonic() - start, 'session')
+            else:
+                process_registry.REGISTRY.unregister(self.key, self._proc.pid)
+            metrics.OPENOCD_EXITS.inc('session', self._proc.returncode)
+            self._proc = None
 
-def killall(name):
-    l = process_pid_list(name)
-    for pid in l:
-        os.kill(pid, signal.SIGTERM)
+    def _supervise(self):
+        while not self._done.wait(1.0):
+            with self._lock:
+                if self._done.is_set() or self.is_running():
+                    continue
+                ret = self._proc.returncode if self._proc is not None else None
+                _LOGGER.error("openocd session exited with code: {}, restarting.".format(ret))
+                try:
+                    self._spawn()
+                except SessionException as e:
+                    _LOGGER.error(e.message)
 
 
-def write_stream_to_file(filename, request_iterator):
-    file = open(filename, "wb")
-    for request in request_iterator:
-        file.write(request.data)
-    file.close()
+class DeltaFlasher:
+    """Programs only the flash sectors changed since the last image programmed on the target.
+    Falls back to a full program when the flash content is unknown."""
 
+    def __init__(self, session, image_cache, layout, reset_cmd, target='default'):
+        self.session = session
+        self.image_cache = image_cache
+        self.layout = layout
+        self.reset_cmd = reset_cmd
+        self.target = target
 
-def process_pid_list(name):
-    res = []
-    for proc in psutil.process_iter(['pid', 'name']):
+    def invalidate(self):
+        self.image_cache.set_programmed(self.target, None)
+
+    def program(self, image, program_cmd):
+        last = self.image_cache.programmed(self.target)
+        ranges = self._plan(last, image) if last is not None else None
+        # flash content is undefined until the command sequence completes
+        self.invalidate()
+        if ranges is not None:
+            try:
+                yield from self._program_ranges(image, ranges)
+                self.image_cache.set_programmed(self.target, image)
+                return
+            except SessionException as e:
+                if self.session.is_aborted():
+                    raise
+                _LOGGER.warning("Delta flashing failed, programming full image: {}".format(e.message))
+        yield from self.session.run(program_cmd)
+        self.image_cache.set_programmed(self.target, image)
+
+    def _plan(self, last, image):
         try:
-            if proc.name() == name:
-                res.append(proc.pid)
-        except (psutil.NoSuchProcess, psutil.AccessDenied):
-            pass
-    return res
+            old = sector_contents(load_segments_from_file(last), self.layout)
+            new = sector_contents(load_segments_from_file(image), self.layout)
+        except (OSError, ElfException) as e:
+            _LOGGER.warning("Delta flashing not possible: {}".format(e))
+            return None
+        if old is None or new is None:
+            return None
+        return changed_ranges(old, new, self.layout)
+
+    def _program_ranges(self, image, ranges):
+        yield 'delta flashing {} sector range(s)\n'.format(len(ranges))
+        yield from self.session.run('reset halt')
+        for addr, data in ranges:
+            with tempfile.NamedTemporaryFile(suffix='.bin') as tmp:
+                tmp.write(data)
+                tmp.flush()
+                yield from self.session.run('flash write_image erase {} 0x{:08x} bin'.format(tmp.name, addr))
+        yield from self.session.run('verify_image {}'.format(image))
+        yield from self.session.run(self.reset_cmd)
+
+
+class Device:
+    """A debug probe with its own openocd instance. Operations on a device run as jobs of 'queue'.
+    Created in the event loop of the server, openocd session commands run in the default executor."""
+
+    def __init__(self, name, config, image_cache=None):
+        self.name = name
+        self.config = config
+        self.queue = JobQueue()
+        self._debug = None
+        # lease of the debug session, the session is stopped when it expires
+        self.lease_ttl = float(config.get('debug_lease_ttl', '30'))
+        self._lease = None
+        self._lease_timer = None
+        self._expiring = set()
+        self.session = None
+        if config.get('session') == 'enabled':
+            self.session = OpenOcdSession(self._format('cmd_session'), int(config.get('tcl_port', '6666')),
+                                          float(config.get('session_timeout', '10')), self._key('session'))
+        self.delta = None
+        if config.get('delta_flash') == 'enabled':
+            if self.session is None or image_cache is None:
+                raise ConfigException(f"Error: 'delta_flash' requires 'session' and 'image_cache' [{name}].")
+            layout = parse_sector_layout(config['flash_sectors'])
+            self.delta = DeltaFlasher(self.session, image_cache, layout, self._format('tcl_reset'), name)
+
+    def _key(self, kind):
+        # PID file of the openocd process of this device
+        return f'rpcd.{self.name}.{kind}'
+
+    def _format(self, key, *args):
+        # commands may refer to device keys, e.g. {tcl_port}
+        return self.config[key].format(*args, **self.config)
+
+    def start(self):
+        if self.session is not None:
+            self.session.start()
+
+    async def stop(self):
+        await self.stop_debug()
+        if self.session is not None:
+            self.session.stop()
+
+    def openocd(self, cmd, *args):
+        """Returns an async iterator of the output lines."""
+        if self.session is not None:
+            return self._in_session(self.session.run(self._format('tcl_' + cmd, *args)))
+        return self._openocd_cmd(cmd, *args)
+
+    async def _in_session(self, lines):
+        # a cancelled command is aborted, the session is free for the next job when this returns
+        try:
+            async for line in in_thread(lines, self.session.abort):
+                yield line
+        finally:
+            self.session.resume()
+
+    async def _openocd_cmd(self, cmd, *args):
+        await self.stop_debug()
+        lines = openocd_cmd(self._format('cmd_' + cmd, *args), cmd, self._key('cmd'))
+        try:
+            async for line in lines:
+                yield line
+        finally:
+            # closing this generator terminates openocd
+            await lines.aclose()
+
+    def program(self, image):
+        if self.delta is not None:
+            return self._in_session(self.delta.program(image, self._format('tcl_program', image)))
+        return self.openocd('program', image)
+
+    async def start_debug(self):
+        if self.delta is not None:
+            # gdb may write to flash
+            self.delta.invalidate()
+        if self.session is not None:
+            # gdb connects to the gdb port of the running session
+            if not self.session.is_running():
+                await asyncio.get_running_loop().run_in_executor(None, self.session.start)
+        else:
+            await self.stop_debug()
+            self._debug = await openocd_start_debug(self._format('cmd_debug'), self._key('debug'),
+                                                    ReadyCheck.from_config(self.config))
+
+    async def stop_debug(self):
+        self._end_lease()
+        if self._debug is not None:
+            debug, self._debug = self._debug, None
+            await openocd_terminate(debug, self._key('debug'))
+
+    def lease(self, client):
+        """Returns the ID of a new lease of 'client' on the debug session. The session is stopped if
+        the lease is not renewed within 'lease_ttl' seconds. Until then the device is reserved for
+        the client, the jobs of others wait."""
+        self._end_lease()
+        self._lease = secrets.token_hex(8)
+        self._start_timer()
+        self.queue.reserve(client)
+        return self._lease
+
+    def renew(self, lease_id):
+        """Returns False if the lease has ended."""
+        if not lease_id or lease_id != self._lease:
+            return False
+        self._lease_timer.cancel()
+        self._start_timer()
+        return True
+
+    def holds(self, lease_id):
+        return lease_id == self._lease
+
+    def _start_timer(self):
+        self._lease_timer = asyncio.get_running_loop().call_later(self.lease_ttl, self._expire)
+
+    def _end_lease(self):
+        if self._lease_timer is not None:
+            self._lease_timer.cancel()
+        self._lease = self._lease_timer = None
+        self.queue.reserve(None)
+
+    def _expire(self):
+        _LOGGER.info(f"Debug lease on '{self.name}' expired.")
+        self._lease = self._lease_timer = None
+        self.queue.reserve(None)
+        task = asyncio.ensure_future(self._stop_expired(self._debug))
+        self._expiring.add(task)
+        task.add_done_callback(self._expiring.discard)
+
+    async def _stop_expired(self, debug):
+        # waits for the running operation, e.g. a StartDebug starting a new session
+        job = self.queue.job('lease', PRIORITY_INTERACTIVE, 'stop')
+        try:
+            async for _position, _eta in self.queue.wait(job):
+                pass
+            if self._lease is None and debug is not None and self._debug is debug:
+                _LOGGER.info(f"Stopping the debug session of '{self.name}'.")
+                await self.stop_debug()
+        finally:
+            self.queue.done(job)
 
 
 class LogReader:
-    def __init__(self):
-        self.done = False
-        pass
-
-    def read(self, filename):
-        with open(filename, 'r') as file:
-            line = ''
-            while not self.done:
-                tmp = file.readline()
-                if tmp != "":
-                    line += tmp
-                    if line.endswith("\n"):
-                        yield line
-                        line = ''
-                else:
-                    sleep(0.1)
+    """Log streams of one RPC. The generators stop when the task running them is cancelled."""
 
-    def abort(self):
-        self.done = True
+    def __init__(self, sources=None, line_filter=None):
+        self._sources = sources
+        self._filter = line_filter
+
+    async def _read(self, subscriber, timeout=None):
+        lost, lines = await subscriber.read(timeout)
+        if self._filter is None:
+            return lost, 0, lines
+        lines, n_suppressed = self._filter.filter(lines)
+        return lost, n_suppressed, lines
+
+    async def read(self, filename, resume_from=0):
+        """Yields (offset, lost, suppressed, line) from stream offset 'resume_from'. 'offset' is the
+        stream offset after the line, 'lost' the number of bytes skipped before it and 'suppressed'
+        the number of lines dropped by the rate limit before it."""
+        subscriber = await self._sources.subscribe(filename, resume_from)
+        lost = suppressed = 0
+        try:
+            while True:
+                n_lost, n_suppressed, lines = await self._read(subscriber)
+                lost += n_lost
+                suppressed += n_suppressed
+                if not lines and subscriber.source.closed:
+                    break
+                for offset, line in lines:
+                    yield offset, lost, suppressed, line.decode(errors='replace')
+                    lost = suppressed = 0
+        finally:
+            self._sources.unsubscribe(subscriber)
+
+    async def read_blocks(self, filename, interval, max_bytes, resume_from=0):
+        """Yields (offset, lost, suppressed, block) with blocks of whole lines. A block is sent when
+        'max_bytes' is reached, or 'interval' seconds after the oldest line in it was read."""
+        subscriber = await self._sources.subscribe(filename, resume_from)
+        pending, size, pending_lost, suppressed, since = [], 0, 0, 0, None
+        try:
+            while True:
+                timeout = None if since is None else since + interval - monotonic()
+                if timeout is None or timeout > 0:
+                    lost, n_suppressed, lines = await self._read(subscriber, timeout)
+                    if not lines and subscriber.source.closed:
+                        break
+                    if lost and pending:
+                        # keep the gap at a block boundary
+                        for block in self._blocks(pending, pending_lost, suppressed, max_bytes):
+                            yield block
+                        pending, size, pending_lost, suppressed, since = [], 0, 0, 0, None
+                    pending_lost += lost
+                    suppressed += n_suppressed
+                    if lines:
+                        pending += lines
+                        size += sum(len(line) for _end, line in lines)
+                        since = since or monotonic()
+                if not pending or size < max_bytes and monotonic() < since + interval:
+                    continue
+                for block in self._blocks(pending, pending_lost, suppressed, max_bytes):
+                    yield block
+                pending, size, pending_lost, suppressed, since = [], 0, 0, 0, None
+        finally:
+            self._sources.unsubscribe(subscriber)
+
+    @staticmethod
+    def _blocks(lines, lost, suppressed, max_bytes):
+        block, size = [], 0
+        for end, line in lines:
+            if block and size + len(line) > max_bytes:
+                yield block_end, lost, suppressed, b''.join(block)
+                block, size, lost, suppressed = [], 0, 0, 0
+            block.append(line)
+            size += len(line)
+            block_end = end
+        yield block_end, lost, suppressed, b''.join(block)
+
+    async def read_itm(self, filename, ports, ts_freq):
+        """Yields (suppressed, lines) with lists of ItmLine decoded from a raw ITM trace file."""
+        tail = FileTail(filename)
+        decoder = ItmDecoder(ports, ts_freq)
+        overflows = suppressed = 0
+        try:
+            while True:
+                lines = decoder.feed(await tail.read())
+                if decoder.overflows != overflows:
+                    _LOGGER.warning(f"ITM overflow in '{filename}', trace data lost.")
+                    overflows = decoder.overflows
+                if self._filter is not None and lines:
+                    lines, n_suppressed = self._filter.filter(lines, attrgetter('data'))
+                    suppressed += n_suppressed
+                if lines:
+                    yield suppressed, lines
+                    suppressed = 0
+        finally:
+            tail.close()
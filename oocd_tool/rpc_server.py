@@ -8,127 +8,452 @@
 #
 
 import argparse
+import asyncio
+import contextlib
 import grpc
+import grpc.aio
+import itertools
 import logging
-import threading
 import tempfile
 from pathlib import Path
 from configparser import ConfigParser
-from concurrent import futures
+from time import monotonic
 
 import oocd_tool._credentials as _credentials
+import oocd_tool.metrics as metrics
+import oocd_tool.process_registry as process_registry
 import oocd_tool.openocd_pb2 as openocd_pb2
 import oocd_tool.openocd_pb2_grpc as openocd_pb2_grpc
+from oocd_tool.image_cache import ImageCache, ImageCacheException
+from oocd_tool.log_buffer import LogSources, LogBufferException, LAG_DROP
+from oocd_tool.job_queue import JobQueueException
+from oocd_tool.log_filter import LogFilterException, line_filter
+from oocd_tool.compression import CompressionException, available_encodings, decompress_stream
 from oocd_tool.rpc_impl import *
 
 _LOGGER = logging.getLogger(__name__)
 
+_BATCH_SIZE = 16384
+_MAX_BATCH_SIZE = 1 << 20
+# gdb data read from openocd is sent in messages of up to this size, whatever arrived since the last one
+_GDB_CHUNK = 65536
+# accept the keepalive pings of clients on idle log streams
+_SERVER_OPTIONS = [('grpc.http2.min_recv_ping_interval_without_data_ms', 5000), ('grpc.http2.max_ping_strikes', 0)]
+
 
 class OpenOcd(openocd_pb2_grpc.OpenOcdServicer):
 
-    def __init__(self, config):
+    def __init__(self, config, devices, image_cache=None):
         super(OpenOcd, self).__init__()
         self.config = config
-
-    def LogStreamCreate(self, request, context):
+        self.devices = devices
+        self.default_device = config.get('default_device', next(iter(devices)))
+        self.image_cache = image_cache
+        self.log_sources = LogSources(int(config.get('log_buffer_size', '1024')) * 1024,
+                                      float(config.get('log_retention', '60')),
+                                      int(config.get('log_queue_size', '1024')) * 1024,
+                                      config.get('log_lag_policy', LAG_DROP),
+                                      int(config.get('max_log_streams', '256')))
+
+    async def _device(self, name, context):
+        device = self.devices.get(name or self.default_device)
+        if device is None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"Unknown device: '{name}'")
+        return device
+
+    async def LogStreamCreate(self, request, context):
         _LOGGER.info("LogStreamCreate called.")
-        stop_event = threading.Event()
-        log_reader = LogReader()
-
-        def on_rpc_done():
-            _LOGGER.debug("Attempting to regain servicer thread.")
-            stop_event.set()
-            log_reader.abort()
-
-        context.add_callback(on_rpc_done)
-        log_output = log_reader.read(request.filename)
+        try:
+            log_filter = line_filter(request.include, request.exclude, request.context, request.rate_limit)
+        except LogFilterException as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, e.message)
+        log_reader = LogReader(self.log_sources, log_filter)
 
+        # a cancelled stream raises CancelledError at the await it is suspended in
         try:
-            for data in log_output:
-                yield openocd_pb2.LogStreamResponse(data=data)
-        except:
+            if request.itm:
+                batched = request.batch_interval_ms or request.batch_size
+                async for suppressed, lines in log_reader.read_itm(request.filename, list(request.ports),
+                                                                   request.ts_freq):
+                    if batched:
+                        # one frame per run of lines from the same port
+                        for port, group in itertools.groupby(lines, key=lambda line: line.port):
+                            group = list(group)
+                            yield openocd_pb2.LogStreamResponse(lines=b''.join(line.data for line in group),
+                                                                port=port, timestamp=group[0].timestamp,
+                                                                suppressed=suppressed)
+                            suppressed = 0
+                    else:
+                        for line in lines:
+                            yield openocd_pb2.LogStreamResponse(data=line.data.decode(errors='replace'),
+                                                                port=line.port, timestamp=line.timestamp,
+                                                                suppressed=suppressed)
+                            suppressed = 0
+            elif request.batch_interval_ms or request.batch_size:
+                batch_size = min(request.batch_size or _BATCH_SIZE, _MAX_BATCH_SIZE)
+                blocks = log_reader.read_blocks(request.filename, request.batch_interval_ms / 1000, batch_size,
+                                                request.resume_from)
+                async for offset, lost, suppressed, block in blocks:
+                    yield openocd_pb2.LogStreamResponse(lines=block, offset=offset, lost=lost, suppressed=suppressed)
+            else:
+                async for offset, lost, suppressed, data in log_reader.read(request.filename, request.resume_from):
+                    yield openocd_pb2.LogStreamResponse(data=data, offset=offset, lost=lost, suppressed=suppressed)
+        except LogBufferException as e:
+            # too many streams, or a lagging stream with policy 'disconnect'. The client resumes later.
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, e.message)
+        except OSError as e:
             _LOGGER.info("Cancelling RPC LogStreamOpen.")
-            context.cancel()
-
-        _LOGGER.debug("Regained servicer thread.")
-
-    def ProgramDevice(self, request_iterator, context):
-        _LOGGER.info("StartDebug called.")
-        stop_event = threading.Event()
-
-        def on_rpc_done():
-            _LOGGER.debug("Attempting to regain servicer thread.")
-            stop_event.set()
+            await context.abort(grpc.StatusCode.CANCELLED, str(e))
 
-        context.add_callback(on_rpc_done)
-        tmp = tempfile.NamedTemporaryFile()
-        write_stream_to_file(tmp.name, request_iterator)
-        log_output = openocd_cmd(self.config['cmd_program'].format(tmp.name))
+        _LOGGER.debug("Log stream done.")
 
+    async def ProgramDevice(self, request_iterator, context):
+        _LOGGER.info("ProgramDevice called.")
+        first = await _first(request_iterator, openocd_pb2.ProgramRequest())
+        device = await self._device(first.device, context)
+        request_iterator = _chain(first, request_iterator)
+        start = monotonic()
         try:
-            for data in log_output:
-                yield openocd_pb2.LogStreamResponse(data=data)
-        except:
-            _LOGGER.info("Cancelling RPC RunOpenOcd.")
-            context.cancel()
-
-        _LOGGER.debug("Regained servicer thread.")
+            if self.image_cache is not None:
+                image = await self._receive_image(request_iterator, context)
+            else:
+                tmp = tempfile.NamedTemporaryFile()
+                digest = await write_stream_to_file(tmp.name, self._image_chunks(request_iterator, first.encoding,
+                                                                                 context))
+                if first.digest and digest != first.digest:
+                    # also an upload cut short by a cancelled RPC
+                    await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                        'Error: uploaded image does not match digest.')
+                image = tmp.name
+        except CompressionException as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, e.message)
+        elapsed = monotonic() - start
+        metrics.PROGRAM_PHASE.observe(elapsed, device.name, 'upload')
+        if first.data and elapsed > 0:
+            metrics.UPLOAD_THROUGHPUT.observe(os.path.getsize(image) / elapsed)
+
+        start = monotonic()
+        job = _job(device, first, 'program', context)
+        try:
+            async for response in _wait_turn(device, job, context):
+                yield response
+            metrics.PROGRAM_PHASE.observe(monotonic() - start, device.name, 'queue')
+            with metrics.PROGRAM_PHASE.time(device.name, 'program'):
+                async for data in _cancel_on_error(device.program(image), context):
+                    yield openocd_pb2.LogStreamResponse(data=data)
+        finally:
+            device.queue.done(job)
+            if self.image_cache is not None:
+                self.image_cache.release(image)
+
+        _LOGGER.debug("ProgramDevice done.")
+
+    async def _receive_image(self, request_iterator, context):
+        first = await _first(request_iterator)
+        try:
+            if first.digest and not first.data:
+                # held until programmed, other devices may store images meanwhile
+                image = self.image_cache.lookup(first.digest, hold=True)
+                if image is None:
+                    await context.abort(grpc.StatusCode.FAILED_PRECONDITION, 'Image not cached')
+                return image
+            chunks = self._image_chunks(_chain(first, request_iterator), first.encoding, context)
+            return await self.image_cache.store(chunks, first.digest, hold=True)
+        except ImageCacheException as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, e.message)
+
+    @staticmethod
+    async def _image_chunks(request_iterator, encoding, context):
+        async def received():
+            async for request in request_iterator:
+                metrics.UPLOAD_BYTES.inc('sent', amount=len(request.data))
+                yield request.data
+            if context.cancelled():
+                # the request stream of a cancelled RPC just ends, the image is incomplete
+                _LOGGER.info("Upload cancelled.")
+                raise asyncio.CancelledError()
+
+        async for chunk in decompress_stream(received(), encoding):
+            metrics.UPLOAD_BYTES.inc('image', amount=len(chunk))
+            yield chunk
+
+    async def QueryImage(self, request, context):
+        _LOGGER.info("QueryImage called.")
+        try:
+            cached = self.image_cache is not None and self.image_cache.lookup(request.digest) is not None
+        except ImageCacheException as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, e.message)
+        return openocd_pb2.ImageResponse(cached=cached, encodings=available_encodings())
 
-    def ResetDevice(self, request, context):
+    async def ResetDevice(self, request, context):
         _LOGGER.info("ResetDevice called")
-        log_output = openocd_cmd(self.config['cmd_reset'])
+        device = await self._device(request.device, context)
+        job = _job(device, request, 'reset', context)
         try:
-            for data in log_output:
+            async for response in _wait_turn(device, job, context):
+                yield response
+            async for data in _cancel_on_error(device.openocd('reset'), context):
                 yield openocd_pb2.LogStreamResponse(data=data)
-        except:
-            _LOGGER.info("Cancelling RPC RunOpenOcd.")
-            context.cancel()
-
-        _LOGGER.debug("Regained servicer thread.")
-
-    def StartDebug(self, request, context):
-        openocd_start_debug(self.config['cmd_debug'])
-        _LOGGER.info("StartDebug called.")
-        return openocd_pb2.void()
-
-    def StopDebug(self, request, context):
-        openocd_terminate()
+        finally:
+            device.queue.done(job)
+
+        _LOGGER.debug("ResetDevice done.")
+
+    async def StartDebug(self, request, context):
+        device = await self._device(request.device, context)
+        async with _queued(device, request, 'debug', context) as job:
+            try:
+                await device.start_debug()
+            except ReadinessException as e:
+                await context.abort(grpc.StatusCode.UNAVAILABLE, e.message)
+            if not request.lease:
+                _LOGGER.info("StartDebug called.")
+                return openocd_pb2.DebugLease(device=device.name)
+            lease_id = device.lease(job.client)
+        _LOGGER.info(f"StartDebug called, lease {lease_id}.")
+        return openocd_pb2.DebugLease(device=device.name, lease_id=lease_id, ttl_ms=int(device.lease_ttl * 1000))
+
+    async def RenewDebug(self, request, context):
+        device = await self._device(request.device, context)
+        if not device.renew(request.lease_id):
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"Error: debug lease '{request.lease_id}' has ended.")
+        return openocd_pb2.DebugLease(device=device.name, lease_id=request.lease_id,
+                                      ttl_ms=int(device.lease_ttl * 1000))
+
+    async def StopDebug(self, request, context):
+        device = await self._device(request.device, context)
+        async with _queued(device, request, 'stop', context):
+            # the session may have expired and belong to someone else by now
+            if not request.lease_id or device.holds(request.lease_id):
+                await device.stop_debug()
         _LOGGER.info("StopDebug called.")
         return openocd_pb2.void()
 
-
-class SignatureValidationInterceptor(grpc.ServerInterceptor):
+    async def GdbTunnel(self, request_iterator, context):
+        first = await _first(request_iterator, openocd_pb2.GdbData())
+        device = await self._device(first.device, context)
+        port = int(device.config.get('gdb_port', '3333'))
+        try:
+            reader, writer = await asyncio.open_connection('localhost', port)
+        except OSError as e:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, f"Error: no gdb server on port {port} of "
+                                f"'{device.name}', debug session not started? ({e})")
+        _LOGGER.info(f"GdbTunnel to '{device.name}' opened.")
+        upstream = asyncio.ensure_future(_forward_gdb(_chain(first, request_iterator), writer))
+        try:
+            while True:
+                data = await reader.read(_GDB_CHUNK)
+                if not data:
+                    break
+                yield openocd_pb2.GdbData(data=data)
+        finally:
+            upstream.cancel()
+            writer.close()
+        _LOGGER.info(f"GdbTunnel to '{device.name}' closed.")
+
+
+async def _first(request_iterator, default=None):
+    try:
+        return await request_iterator.__anext__()
+    except StopAsyncIteration:
+        return default
+
+
+async def _chain(first, request_iterator):
+    yield first
+    async for request in request_iterator:
+        yield request
+
+
+async def _forward_gdb(request_iterator, writer):
+    """Writes the data from gdb to openocd, closes the connection when gdb is done."""
+    try:
+        async for request in request_iterator:
+            if request.data:
+                writer.write(request.data)
+                await writer.drain()
+    except ConnectionError as e:
+        _LOGGER.info(f"GdbTunnel: {e}")
+    finally:
+        writer.close()
+
+
+def _close_when_done(generator, context):
+    """Closes 'generator' when the RPC ends. A cancelled RPC raises CancelledError in the
+    generator only if it is waiting for openocd, not while the response is sent."""
+    def close(_context):
+        async def aclose():
+            # RuntimeError: still running, it gets the CancelledError itself
+            with contextlib.suppress(RuntimeError):
+                await generator.aclose()
+        task = asyncio.ensure_future(aclose())
+        _closing.add(task)
+        task.add_done_callback(_closing.discard)
+
+    if context.done():
+        close(context)
+    else:
+        context.add_done_callback(close)
+
+
+# tasks closing generators, referenced until they are done
+_closing = set()
+
+
+async def _cancel_on_error(lines, context):
+    """Yields the output lines of an openocd command, a failing command cancels the RPC.
+    The command is terminated when the RPC is cancelled."""
+    _close_when_done(lines, context)
+    try:
+        async for line in lines:
+            yield line
+    except (subprocess.CalledProcessError, SessionException, OSError) as e:
+        _LOGGER.info(f"Cancelling RPC: {e}")
+        await context.abort(grpc.StatusCode.CANCELLED, str(e))
+
+
+def _job(device, request, kind, context):
+    """Queues a job for 'request' on 'device', within the deadline of the RPC if it has one."""
+    # clients not telling who they are are told apart by host, not by connection
+    client = request.client or context.peer().rpartition(':')[0]
+    return device.queue.job(client, request.priority, kind, context.time_remaining())
+
+
+async def _wait_turn(device, job, context):
+    """Yields the queue position of 'job' until it may run, aborts the RPC if it would miss the deadline."""
+    metrics.DEVICE_WAITING.inc(device.name)
+    try:
+        async for position, eta in device.queue.wait(job):
+            _LOGGER.debug(f"Queued on '{device.name}': position {position}.")
+            yield openocd_pb2.LogStreamResponse(queue_position=position,
+                                                queue_eta_ms=0 if eta is None else max(int(eta * 1000), 1))
+    except JobQueueException as e:
+        await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, e.message)
+    finally:
+        metrics.DEVICE_WAITING.dec(device.name)
+
+
+@contextlib.asynccontextmanager
+async def _queued(device, request, kind, context):
+    """Runs the body as a job on 'device', for RPCs without a response stream."""
+    job = _job(device, request, kind, context)
+    try:
+        async for _response in _wait_turn(device, job, context):
+            pass
+        yield job
+    finally:
+        device.queue.done(job)
+
+
+def _status_code(context):
+    # grpc.aio returns the numeric code once the RPC was aborted
+    code = context.code()
+    if isinstance(code, int):
+        return next((status for status in grpc.StatusCode if status.value[0] == code), grpc.StatusCode.UNKNOWN)
+    return code
+
+
+class MetricsInterceptor(grpc.aio.ServerInterceptor):
+    """Counts RPCs by status code and observes their duration, streaming RPCs until the last response."""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = handler_call_details.method.split('/')[-1]
+
+        def finished(context, start, code):
+            metrics.RPC_LATENCY.observe(monotonic() - start, method)
+            if code is None:
+                code = _status_code(context) or grpc.StatusCode.OK
+            metrics.RPC_REQUESTS.inc(method, code.name)
+
+        def unary(behavior):
+            async def wrapper(request, context):
+                start, code = monotonic(), None
+                try:
+                    return await behavior(request, context)
+                except asyncio.CancelledError:
+                    code = grpc.StatusCode.CANCELLED
+                    raise
+                except Exception:
+                    code = _status_code(context) or grpc.StatusCode.UNKNOWN
+                    raise
+                finally:
+                    finished(context, start, code)
+            return wrapper
+
+        def streaming(behavior):
+            async def wrapper(request, context):
+                start, code = monotonic(), None
+                try:
+                    async for response in behavior(request, context):
+                        yield response
+                except (asyncio.CancelledError, GeneratorExit):
+                    code = grpc.StatusCode.CANCELLED
+                    raise
+                except Exception:
+                    code = _status_code(context) or grpc.StatusCode.UNKNOWN
+                    raise
+                finally:
+                    finished(context, start, code)
+            return wrapper
+
+        kwargs = {'request_deserializer': handler.request_deserializer,
+                  'response_serializer': handler.response_serializer}
+        if handler.unary_unary:
+            return grpc.unary_unary_rpc_method_handler(unary(handler.unary_unary), **kwargs)
+        if handler.unary_stream:
+            return grpc.unary_stream_rpc_method_handler(streaming(handler.unary_stream), **kwargs)
+        if handler.stream_unary:
+            return grpc.stream_unary_rpc_method_handler(unary(handler.stream_unary), **kwargs)
+        return grpc.stream_stream_rpc_method_handler(streaming(handler.stream_stream), **kwargs)
+
+
+class SignatureValidationInterceptor(grpc.aio.ServerInterceptor):
 
     def __init__(self, auth):
         self.auth_key = auth
 
-        def abort(_ignored_request, context):
-            context.abort(grpc.StatusCode.UNAUTHENTICATED, 'Invalid signature')
+        async def abort(_ignored_request, context):
+            await context.abort(grpc.StatusCode.UNAUTHENTICATED, 'Invalid signature')
 
         self._abortion = grpc.unary_unary_rpc_method_handler(abort)
 
-    def intercept_service(self, continuation, handler_call_details):
+    async def intercept_service(self, continuation, handler_call_details):
         method_name = handler_call_details.method.split('/')[-1]
         expected_metadata = (self.auth_key, method_name[::-1])
         if expected_metadata in handler_call_details.invocation_metadata:
-            return continuation(handler_call_details)
+            return await continuation(handler_call_details)
         else:
             return self._abortion
 
 
-def _running_server(config):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2), maximum_concurrent_rpcs=1)
-    openocd_pb2_grpc.add_OpenOcdServicer_to_server(OpenOcd(config), server)
+def load_devices(parser, image_cache):
+    """Devices are configured in [device.<name>] sections, defaults to a single device from [DEFAULT]."""
+    devices = {}
+    for section in parser.sections():
+        if section.startswith('device.'):
+            name = section[len('device.'):]
+            devices[name] = Device(name, parser[section], image_cache)
+    if not devices:
+        devices['default'] = Device('default', parser['DEFAULT'], image_cache)
+    return devices
+
+
+async def _running_server(config, servicer):
+    server = grpc.aio.server(interceptors=(MetricsInterceptor(),), options=_SERVER_OPTIONS)
+    openocd_pb2_grpc.add_OpenOcdServicer_to_server(servicer, server)
     server.add_insecure_port(config['bindto'])
-    server.start()
+    await server.start()
     return server
 
 
-def _running_tls_server(config, auth):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2), maximum_concurrent_rpcs=1,
-                         interceptors=(SignatureValidationInterceptor(auth),))
+async def _running_tls_server(config, servicer, auth):
+    server = grpc.aio.server(interceptors=(MetricsInterceptor(), SignatureValidationInterceptor(auth)),
+                             options=_SERVER_OPTIONS)
 
-    openocd_pb2_grpc.add_OpenOcdServicer_to_server(OpenOcd(config), server)
+    openocd_pb2_grpc.add_OpenOcdServicer_to_server(servicer, server)
 
     server_credentials = grpc.ssl_server_credentials(((
                                                           _credentials.SERVER_CERTIFICATE_KEY,
@@ -136,10 +461,42 @@ def _running_tls_server(config, auth):
                                                       ),))
 
     server.add_secure_port(config['bindto'], server_credentials)
-    server.start()
+    await server.start()
     return server
 
 
+async def serve(parser):
+    config = parser['DEFAULT']
+    tls = config.get('tls_mode') != 'disabled'
+    if tls and 'cert_auth_key' not in config:
+        # before any openocd is started
+        raise ConfigException("Error: 'cert_auth_key' not specified.")
+    image_cache = None
+    if 'image_cache' in config:
+        image_cache = ImageCache(config['image_cache'], int(config.get('image_cache_size', '64')) << 20)
+    devices = load_devices(parser, image_cache)
+    if 'pid_dir' in config:
+        process_registry.REGISTRY = process_registry.ProcessRegistry(config['pid_dir'])
+    # openocd left behind by a previous instance holds the probes
+    process_registry.REGISTRY.terminate_all('rpcd.')
+    for device in devices.values():
+        device.start()
+    servicer = OpenOcd(config, devices, image_cache)
+    if 'metrics_bindto' in config:
+        metrics.REGISTRY.register(metrics.Gauge('oocd_log_subscribers', 'Active log streams.',
+                                                function=servicer.log_sources.subscriber_count))
+        metrics.REGISTRY.register(metrics.Gauge('oocd_log_queue_bytes', 'Bytes queued for log streams.',
+                                                function=servicer.log_sources.queued_bytes))
+        metrics.start_http_server(config['metrics_bindto'])
+
+    if not tls:
+        server = await _running_server(config, servicer)
+    else:
+        _credentials.load_certificates(config)
+        server = await _running_tls_server(config, servicer, config['cert_auth_key'])
+    await server.wait_for_termination()
+
+
 def main():
     parser = argparse.ArgumentParser(description='oocd-rpcd')
     parser.add_argument(dest='config_file', nargs='?', metavar='CONFIG', help='configuration file')
@@ -165,17 +522,7 @@ def main():
         else:
             logging.basicConfig()
 
-    config = parser['DEFAULT']
-    if 'tls_mode' in config and config['tls_mode'] == 'disabled':
-        server = _running_server(config)
-    else:
-        if 'cert_auth_key' not in config:
-            _LOGGER.error("'cert_auth_key' not specified.")
-            os.exit(1)
-        _credentials.load_certificates(config)
-        server = _running_tls_server(config, config['cert_auth_key'])
-    server.wait_for_termination()
-
+    asyncio.run(serve(parser))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,186 @@
+#
+# Copyright (C) 2021 Jacob Schultz Andersen schultz.jacob@gmail.com
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+import os
+import struct
+import asyncio
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal inotify binding through ctypes. Raises OSError if inotify is not available."""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify not available')
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path, mask):
+        import ctypes
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed: {path}')
+        return wd
+
+    def read_names(self):
+        """Drains pending events. Returns the set of file names the events refer to."""
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _wd, _mask, _cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                names.add(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileTail:
+    """Follows a file like 'tail -F'. Handles truncation, rotation and files not created yet.
+    Waits for inotify events for the file in the event loop, polls if inotify is not available."""
+
+    def __init__(self, filename, block_size=65536, poll_interval=0.1):
+        self.filename = filename
+        self.block_size = block_size
+        self.poll_interval = poll_interval
+        self._file = None
+        self._inotify = None
+        self._name = os.fsencode(os.path.basename(filename))
+        try:
+            self._inotify = Inotify()
+            self._inotify.add_watch(os.path.dirname(os.path.abspath(filename)), _WATCH_MASK)
+        except OSError as e:
+            _LOGGER.info(f"inotify not used, polling '{filename}': {e}")
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+
+    async def read(self, timeout=None):
+        """Returns the data appended to the file. Waits until data is available or the
+        timeout expires, b'' is returned in the latter case. Cancel the caller to abort."""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            data = self._read_available()
+            if data:
+                return data
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return b''
+            await self._wait(remaining)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _read_available(self):
+        if self._file is None:
+            try:
+                self._file = open(self.filename, 'rb', buffering=0)
+            except FileNotFoundError:
+                return b''
+        data = self._file.read(self.block_size)
+        if data:
+            return data
+        # at end of file, check if the file was replaced or truncated
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return b''
+        fst = os.fstat(self._file.fileno())
+        if (st.st_ino, st.st_dev) != (fst.st_ino, fst.st_dev):
+            _LOGGER.info(f"'{self.filename}' rotated, reopening.")
+            self._file.close()
+            self._file = None
+            return self._read_available()
+        if fst.st_size < self._file.tell():
+            _LOGGER.info(f"'{self.filename}' truncated, reading from start.")
+            self._file.seek(0)
+            return self._file.read(self.block_size)
+        return b''
+
+    async def _wait(self, timeout):
+        if self._inotify is None:
+            await asyncio.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+            return
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            readable = loop.create_future()
+            loop.add_reader(self._inotify.fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await asyncio.wait_for(readable, timeout)
+            except asyncio.TimeoutError:
+                return
+            finally:
+                loop.remove_reader(self._inotify.fd)
+            # the directory is watched, skip events for other files
+            if self._name in self._inotify.read_names():
+                return
+            if deadline is not None:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    return
+
+
+class LineSplitter:
+    """Splits a byte stream into lines, with their line endings. Lines are split from the data as
+    it arrives, only an incomplete last line is kept in a reusable buffer."""
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """Returns the lines completed by 'data'."""
+        buf = self._buf
+        if b'\n' not in data:
+            buf += data
+            return []
+        lines = data.splitlines(keepends=True)
+        if buf:
+            # the pending line may end with a lone '\r'
+            buf += lines[0]
+            lines[0:1] = bytes(buf).splitlines(keepends=True)
+            buf.clear()
+        n = len(lines)
+        while not lines[n - 1].endswith(b'\n'):
+            n -= 1
+        for line in lines[n:]:
+            buf += line
+        del lines[n:]
+        return lines
@@ -22,14 +22,18 @@ setuptools.setup(
     ],
     install_requires = [
          "setuptools>=42",
-         "psutil>=5",
+         "psutil>=5; platform_system=='Windows'",
          "grpcio>=1.41",
-         "grpcio-tools>=1.41"
+         "grpcio-tools>=1.41",
+         "protobuf>=3.20"
     ],
+    extras_require={
+        "zstd": ["zstandard"],
+    },
     keywords='arm gdb cortex cortex-m trace microcontroller',
-    packages = setuptools.find_packages(),
+    packages = setuptools.find_packages(exclude=['benchmarks', 'benchmarks.*']),
     python_requires=">=3.6",
-    scripts = ['bin/oocd-tool', 'bin/oocd-rpcd'],
+    scripts = ['bin/oocd-tool', 'bin/oocd-rpcd', 'bin/oocd-agent'],
     entry_points = {
         "console_scripts": [
             "oocd_tool = oocd_tool.main:main",